@@ -0,0 +1,142 @@
+from __future__ import print_function
+import asyncio, errno, signal, sys
+from system import *
+
+class AsyncSystem(System):
+    """
+The asyncio system class.
+
+This drives a System from an asyncio event loop instead of the select loop in System.start, so the document can be updated from coroutines, sockets, subprocesses and timers of the same loop. stdin is read with loop.add_reader, output is written with loop.add_writer while any is queued, and SIGWINCH and SIGCONT are handled with loop.add_signal_handler instead of the self-pipe.
+
+Timers from call_later and call_every are scheduled directly on the loop.
+
+Transactions posted from other threads with post are handed to the loop with call_soon_threadsafe.
+
+Frames are coalesced like in System: document updates mark the system dirty and schedule a single frame callback, which runs after the input that is currently available has been consumed, and no sooner than max_fps, or in adaptive mode the link to the terminal, allows.
+
+This class requires Python 3.
+"""
+    def __init__(self, max_fps=None, sync=None, adaptive=False, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.frame_handle = None
+        self.input_handle = None
+        self.frame_waiters = []
+        self.writing = False
+        self.stopped = None
+        super(AsyncSystem, self).__init__(max_fps, sync, adaptive)
+
+    def setup_waker(self):
+        # Signals and posted transactions are handed to the loop directly
+        pass
+
+    def setup_signal(self):
+        self.loop.add_signal_handler(signal.SIGWINCH, self.rescale)
+        self.loop.add_signal_handler(signal.SIGCONT, self.restore)
+
+    def add_timer(self, timer):
+        self.loop.call_later(max(0, timer.deadline - clock()), self.fire_timer, timer)
+        return timer
+
+    def fire_timer(self, timer):
+        if timer.cancelled:
+            return
+        if timer.interval is not None:
+            timer.reschedule(clock())
+            self.add_timer(timer)
+        timer.fire()
+
+    def queue(self, cmd):
+        self.pending.append(cmd)
+        self.loop.call_soon_threadsafe(self.handle_queue)
+
+    def schedule_render(self, obj=None):
+        self.dirty = True
+        if self.frame_handle is None:
+            self.frame_handle = self.loop.call_later(self.frame_timeout(), self.frame)
+
+    def frame(self):
+        self.frame_handle = None
+        timeout = self.frame_timeout()
+        if timeout is None:
+            return
+        if timeout > 0:
+            # Scheduled from the previous frame, like by an animation callback
+            self.frame_handle = self.loop.call_later(timeout, self.frame)
+            return
+        self.render()
+
+    def render(self, obj=None, differential=True):
+        super(AsyncSystem, self).render(obj, differential)
+        waiters, self.frame_waiters = self.frame_waiters, []
+        for f in waiters:
+            if not f.done():
+                f.set_result(None)
+
+    def flush_output(self):
+        super(AsyncSystem, self).flush_output()
+        if self.output and not self.writing:
+            self.loop.add_writer(self.outfd, self.flush_output)
+            self.writing = True
+        elif not self.output and self.writing:
+            self.loop.remove_writer(self.outfd)
+            self.writing = False
+
+    def handle_input(self):
+        'Reads all input that is available, and feeds it to the document'
+        while True:
+            try:
+                c = self.read_input()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            if not c:
+                # End of input, which would otherwise keep the fd readable
+                self.loop.remove_reader(sys.stdin.fileno())
+                break
+            self.feed_input(c)
+        self.schedule_input_flush()
+
+    def schedule_input_flush(self):
+        'Schedules taking input held back as the possible start of a marker as keys'
+        if self.input_handle is not None:
+            self.input_handle.cancel()
+            self.input_handle = None
+        timeout = self.input_timeout()
+        if timeout is not None:
+            self.input_handle = self.loop.call_later(timeout, self.flush_input)
+
+    def flush_input(self):
+        self.input_handle = None
+        super(AsyncSystem, self).flush_input()
+        self.schedule_input_flush()
+
+    def next_frame(self):
+        'Returns a future resolved once the next frame has been rendered'
+        f = self.loop.create_future()
+        self.frame_waiters.append(f)
+        return f
+
+    async def update(self, fn, *args, **kwargs):
+        'Applies a document mutation, and waits until a frame showing it has been rendered'
+        res = fn(*args, **kwargs)
+        self.schedule_render()
+        await self.next_frame()
+        return res
+
+    async def run(self):
+        'Runs the user interface until stop is called'
+        self.stopped = self.loop.create_future()
+        self.loop.add_reader(sys.stdin.fileno(), self.handle_input)
+        self.render()
+        try:
+            await self.stopped
+        finally:
+            self.loop.remove_reader(sys.stdin.fileno())
+
+    def stop(self):
+        if self.stopped is not None and not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def start(self):
+        self.loop.run_until_complete(self.run())
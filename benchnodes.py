@@ -0,0 +1,52 @@
+'''Measures the memory and construction time of document nodes.
+
+Run as python benchnodes.py [count]. For every node type, count nodes are
+constructed and kept alive, and the memory allocated per node and the time
+taken per node are printed. The gutter case builds the labels main.py makes
+for every screen of lines: a Text per line, attached to a Style.'''
+from __future__ import print_function
+import sys, time, tracemalloc
+from document import *
+
+def gutter(n):
+    style = Style()
+    style.attach([Text('%5d ' % i) for i in range(n)], _notify=False)
+    return style
+
+cases = [
+    ('Text', lambda n: [Text('label') for i in range(n)]),
+    ('Newline', lambda n: [Newline() for i in range(n)]),
+    ('Tab', lambda n: [Tab() for i in range(n)]),
+    ('Style', lambda n: [Style() for i in range(n)]),
+    ('Block', lambda n: [Block() for i in range(n)]),
+    ('gutter', gutter),
+]
+
+def measure(build, n):
+    'Returns the bytes allocated and the seconds taken per node'
+    build(n // 10)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    nodes = build(n)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del nodes
+
+    best = None
+    for i in range(3):
+        t = time.perf_counter()
+        nodes = build(n)
+        elapsed = time.perf_counter() - t
+        del nodes
+        best = elapsed if best is None else min(best, elapsed)
+    return size / n, best / n
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('%-8s %12s %12s' % ('node', 'bytes/node', 'us/node'))
+    for name, build in cases:
+        size, elapsed = measure(build, n)
+        print('%-8s %12.1f %12.3f' % (name, size, elapsed * 1e6))
+
+if __name__ == '__main__':
+    main()
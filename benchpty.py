@@ -0,0 +1,254 @@
+'''End-to-end latency benchmark, running an interface in a pseudo-terminal.
+
+The script (main.py by default) is started under pty.fork with a fixed
+terminal size, and fed scripted keystrokes and pastes. Most phases write
+every input once the previous frame has completed, and the time from writing
+it to the end of the frame it causes is its latency. The burst phase types
+at a fixed rate regardless of frames, and the latency of every key is the
+time until the end of the first frame completed after it.
+
+The end of a frame is known precisely when the interface uses synchronized
+updates: the probe System sends at startup is answered, and frames end with
+the reset of mode 2026. With --no-sync the probe goes unanswered, and a frame
+ends with the last output before a quiet period.
+
+With --bandwidth, the output is taken to arrive over a link that sends that
+many bytes per second, like a slow SSH connection. Frames end when their last
+byte arrives, the next input is only written once the link is idle, and
+device attributes and status requests are answered once they arrive, which
+is what adaptive mode paces frames by.
+
+All output is fed to a pyte screen. For main.py, the screen is checked to
+show the typed and pasted text at the end of each phase.
+
+Reported per phase are latency percentiles, output bytes per input, and at
+the end the CPU time the interface used.
+
+Run as python benchpty.py [--script main.py] [--python python] [--size 80x24] [--no-sync] [--bandwidth 20000]
+The interface is run with the given python, which needs the version of pyte
+the repo is written for, while this script needs a recent one.'''
+from __future__ import print_function
+import argparse, fcntl, os, pty, select, signal, struct, sys, termios, time
+import pyte
+
+SYNC_PROBE = b'\x1b[?2026$p'
+SYNC_SUPPORTED = b'\x1b[?2026;2$y'
+DEVICE_PROBE = b'\x1b[c'
+DEVICE_ATTRIBUTES = b'\x1b[?62;22c'
+STATUS_PROBE = b'\x1b[5n'
+STATUS_OK = b'\x1b[0n'
+FRAME_END = b'\x1b[?2026l'
+
+TYPED = ['The quick brown fox jumps over the lazy dog.',
+         'Pack my box with five dozen liquor jugs.',
+         'How vexingly quick daft zebras jump!']
+BURST = ['Sphinx of black quartz, judge my vow.',
+         'The five boxing wizards jump quickly.']
+PASTED = ['pasted line %d: %s' % (i, 'lorem ipsum dolor sit amet'[:i % 27]) for i in range(100)]
+
+def keys(lines):
+    res = []
+    for line in lines:
+        res.extend(line)
+        res.append('\r')
+    return res
+
+def phases(rate):
+    '''The scripted input, as (phase, inputs, expected lines, interval) tuples.
+    Every input is written at once, and expected lines are checked for on screen afterwards.
+    Inputs are written every interval seconds, or once the previous frame has completed if it is None.'''
+    return [
+        ('typing', keys(TYPED), TYPED, None),
+        ('paste', ['\x1b[200~' + '\n'.join(PASTED) + '\n\x1b[201~'], PASTED[-10:], None),
+        ('navigate', ['\x1b[A'] * 20 + ['\x1b[B'] * 20, PASTED[-10:], None),
+        ('burst', keys(BURST), BURST, 1.0 / rate),
+    ]
+
+class Session(object):
+    'An interface running in a pseudo-terminal, and a pyte screen following its output'
+    def __init__(self, python, script, width, height, sync, bandwidth):
+        self.sync = sync
+        self.bandwidth = bandwidth
+        self.screen = pyte.Screen(width, height)
+        self.stream = pyte.ByteStream(self.screen)
+        self.requests = [(DEVICE_PROBE, DEVICE_ATTRIBUTES), (STATUS_PROBE, STATUS_OK)]
+        if sync:
+            self.requests.append((SYNC_PROBE, SYNC_SUPPORTED))
+
+        # The time the last byte read arrives over the link, the answers to
+        # send once their requests arrive, as (time, answer), and the time
+        # every frame end was read and arrived, as (read, arrived)
+        self.arrival = 0
+        self.answers = []
+        self.frames = []
+        self.size = 0
+        self.tail = b''
+
+        self.pid, self.fd = pty.fork()
+        if self.pid == 0:
+            fcntl.ioctl(0, termios.TIOCSWINSZ, struct.pack('HHHH', height, width, 0, 0))
+            os.execvp(python, [python, script])
+
+    def read(self, timeout):
+        'Reads the output available within timeout, and answers the requests in it. Returns whether there was any.'
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            while self.answers and self.answers[0][0] <= now:
+                os.write(self.fd, self.answers.pop(0)[1])
+            wait = deadline - now
+            if self.answers:
+                wait = min(wait, self.answers[0][0] - now)
+            r, _, _ = select.select([self.fd], [], [], max(wait, 0))
+            if r:
+                break
+            if time.time() >= deadline:
+                return False
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            return False
+
+        now = time.time()
+        if self.bandwidth:
+            self.arrival = max(self.arrival, now) + len(data) / float(self.bandwidth)
+        else:
+            self.arrival = now
+        self.size += len(data)
+        self.stream.feed(data)
+        for request, answer in self.requests:
+            if request in data:
+                self.answers.append((self.arrival, answer))
+        chunk = self.tail + data
+        if not self.sync or FRAME_END in chunk:
+            self.frames.append((now, self.arrival))
+        self.tail = chunk[-len(FRAME_END) + 1:]
+        return True
+
+    def idle(self):
+        'Waits for the link to send what has been read'
+        while time.time() < self.arrival:
+            self.read(self.arrival - time.time())
+
+    def wait_frame(self, n, quiet, timeout):
+        '''Waits for a frame after the first n to end.
+
+        :returns: float -- The time the frame arrived, or None if there was none'''
+        deadline = time.time() + timeout
+        while self.sync and len(self.frames) <= n or not self.sync:
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            if not self.read(quiet if not self.sync and len(self.frames) > n else left) and len(self.frames) > n:
+                break
+        if len(self.frames) <= n:
+            return None
+        return self.frames[n if self.sync else -1][1]
+
+    def send(self, data, quiet, timeout):
+        'Writes input once the link is idle, and waits for the frame it causes. Returns the latency in seconds and the bytes read.'
+        self.idle()
+        n, size = len(self.frames), self.size
+        start = time.time()
+        os.write(self.fd, data.encode('utf-8'))
+        end = self.wait_frame(n, quiet, timeout)
+        return (end - start if end is not None else None), self.size - size
+
+    def burst(self, inputs, interval, quiet, timeout):
+        '''Writes inputs every interval seconds, and waits for the output to settle.
+
+        :returns: tuple -- The latencies in seconds, None for inputs followed by no frame, and the bytes read'''
+        self.idle()
+        n, size = len(self.frames), self.size
+        start = time.time()
+        written = []
+        for i, data in enumerate(inputs):
+            due = start + i * interval
+            while time.time() < due:
+                self.read(due - time.time())
+            written.append(time.time())
+            os.write(self.fd, data.encode('utf-8'))
+        deadline = time.time() + timeout
+        while time.time() < deadline and (self.read(quiet) or time.time() < self.arrival):
+            pass
+
+        frames = self.frames[n:]
+        latencies = []
+        for t in written:
+            arrived = next((a for r, a in frames if r > t), None)
+            latencies.append(arrived - t if arrived is not None else None)
+        return latencies, self.size - size
+
+    def shows(self, lines):
+        'Returns the expected lines not shown on screen'
+        display = '\n'.join(self.screen.display)
+        return [line for line in lines if line not in display]
+
+    def close(self):
+        'Interrupts the interface, and returns the CPU time it used'
+        os.write(self.fd, b'\x03')
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            pid, status, usage = os.wait4(self.pid, os.WNOHANG)
+            if pid:
+                return usage.ru_utime + usage.ru_stime
+            self.read(0.05)
+        os.kill(self.pid, signal.SIGKILL)
+        pid, status, usage = os.wait4(self.pid, 0)
+        return usage.ru_utime + usage.ru_stime
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end latency benchmark in a pseudo-terminal')
+    parser.add_argument('--script', default='main.py', help='the interface to run')
+    parser.add_argument('--python', default=sys.executable, help='the python to run it with')
+    parser.add_argument('--size', default='80x24', help='terminal size, as WIDTHxHEIGHT')
+    parser.add_argument('--no-sync', dest='sync', action='store_false', help='do not report synchronized update support')
+    parser.add_argument('--bandwidth', type=int, help='bytes per second of the simulated link to the terminal')
+    parser.add_argument('--rate', type=float, default=100, help='keys per second typed in the burst phase')
+    parser.add_argument('--quiet', type=float, default=0.05, help='seconds without output ending a frame')
+    parser.add_argument('--timeout', type=float, default=2.0, help='seconds to wait for a frame')
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split('x'))
+    session = Session(args.python, args.script, width, height, args.sync, args.bandwidth)
+    session.wait_frame(0, 0.5, 5.0)
+    session.idle()
+    check = os.path.basename(args.script) == 'main.py'
+
+    print('%-9s %6s %8s %8s %8s %8s %10s %8s' % (
+        'phase', 'inputs', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'bytes/in', 'check'))
+    failed = False
+    for name, inputs, expected, interval in phases(args.rate):
+        if interval is None:
+            latencies, size = [], 0
+            for data in inputs:
+                latency, n = session.send(data, args.quiet, args.timeout)
+                latencies.append(latency)
+                size += n
+        else:
+            latencies, size = session.burst(inputs, interval, args.quiet, args.timeout * 10)
+        missed = latencies.count(None)
+        latencies = [latency * 1e3 for latency in latencies if latency is not None]
+        missing = session.shows(expected) if check else []
+        failed = failed or bool(missing) or bool(missed)
+        status = ('ok' if not missing else 'FAIL') if check else '-'
+        if latencies:
+            print('%-9s %6d %8.2f %8.2f %8.2f %8.2f %10.1f %8s' % (
+                name, len(inputs), percentile(latencies, 50), percentile(latencies, 90),
+                percentile(latencies, 99), max(latencies), size / float(len(inputs)), status))
+        else:
+            print('%-9s %6d %8s %8s %8s %8s %10.1f %8s' % (name, len(inputs), '-', '-', '-', '-', 0, status))
+        if missed:
+            print('  %d inputs caused no output' % missed)
+        for line in missing:
+            print('  not on screen: %r' % line)
+
+    print('cpu time: %.3fs' % session.close())
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
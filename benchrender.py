@@ -0,0 +1,232 @@
+'''Headless render benchmark.
+
+Builds documents like the ones real interfaces use, mutates them the way
+those interfaces do between frames, and renders them with Renderer.render,
+which paints the ScreenBuffer and compiles it, without a terminal.
+
+For every scene, terminal size and path, it reports frames per second, bytes
+emitted per frame, and the peak memory traced by tracemalloc while rendering
+a frame. The full path renders every frame from scratch,
+the differential path renders against the previous frame.
+
+Run as python benchrender.py [--frames N] [--sizes 80x24,200x60] [--scenes log,editor] [--json]
+With --json, one JSON object per result is printed instead of the table, for
+comparing runs.'''
+from __future__ import print_function
+import argparse, json, random, sys, time, tracemalloc
+from document import *
+from system import Renderer
+
+class Scene(object):
+    'A document, and a step mutating it the way an interface does between frames'
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.document = Document()
+        self.random = random.Random(1)
+        self.build()
+
+    def build(self):
+        raise NotImplementedError
+
+    def step(self, i):
+        raise NotImplementedError
+
+
+class EditorScene(Scene):
+    'The editor of main.py: a gutter, a text buffer with a cursor, and a modeline. Typing and moving down a line.'
+    name = 'editor'
+    lines = 5000
+
+    def build(self):
+        body = Block()
+        self.gutter = Block()
+        self.gutter.width = 6
+        self.gutter.margin_bottom = 1
+        self.editor = Block()
+        self.editor.margin_left = 7
+        self.editor.margin_bottom = 1
+        self.cursor = Block()
+        cursor_style = StyleOverride()
+        cursor_style.bg_color = 'white'
+        cursor_style.color = 'black'
+        self.cursor.attach(cursor_style)
+        text = '\n'.join('    line %d of the buffer, %s' % (i, 'x' * (i % 60)) for i in range(self.lines))
+        self.buffer = TextBuffer(text)
+        self.editor.attach([self.cursor, self.buffer])
+        modeline = Block()
+        modeline.absolute = True
+        modeline.height = 1
+        modeline.pos_y = self.height - 1
+        modeline.attach(Text(' newui'))
+        body.attach([self.gutter, self.editor, modeline])
+        self.document.attach(body)
+        self.update_gutter()
+        self.pos = 0
+
+    def update_gutter(self):
+        style = Style()
+        style.bg_color = 'white'
+        style.color = 'black'
+        top = self.buffer.top_line
+        style.attach([Text('%5d ' % (top + i + 1)) for i in range(self.height - 1)])
+        if len(self.gutter):
+            self.gutter.detach(index=0, _notify=False)
+        self.gutter.attach(style)
+
+    def step(self, i):
+        rope = self.buffer.rope
+        if i % 8 == 7:
+            # Move down a line, scrolling at the bottom
+            line = rope.line_of(self.pos) + 1
+            self.pos = rope.line_start(line)
+            if line - self.buffer.top_line >= self.height - 1:
+                self.buffer.top_line += 1
+                self.update_gutter()
+        else:
+            self.buffer.insert(self.pos, 'a')
+            self.pos += 1
+        line = rope.line_of(self.pos)
+        self.cursor.margin_left = self.pos - rope.line_start(line)
+        self.cursor.margin_top = line - self.buffer.top_line
+        self.cursor._notify()
+
+
+class LogScene(Scene):
+    'A log viewer following the tail of 100k lines. Appending a line and scrolling to it.'
+    name = 'log'
+    lines = 100000
+
+    def build(self):
+        body = Block()
+        self.log = Block()
+        self.log.attach([n for i in range(self.lines) for n in (Text(self.line(i)), Newline())], _notify=False)
+        body.attach(self.log)
+        self.document.attach(body)
+        self.count = self.lines
+        self.follow()
+
+    def line(self, i):
+        return '2016-01-01 12:00:%02d worker-%d: request %d handled in %dms' % (
+            i % 60, i % 8, i, self.random.randint(1, 999))
+
+    def follow(self):
+        self.log.scroll = max(self.count - self.height, 0)
+
+    def step(self, i):
+        self.log.attach([Text(self.line(self.count)), Newline()])
+        self.count += 1
+        self.follow()
+
+
+class DashboardScene(Scene):
+    'A grid of small panels with colored values, a tenth of which change every frame.'
+    name = 'dashboard'
+    colors = ['red', 'green', 'yellow', 'blue', 'white']
+
+    def build(self):
+        body = Block()
+        self.values = []
+        for y in range(0, self.height - 2, 3):
+            for x in range(0, self.width - 12, 13):
+                panel = Block()
+                panel.absolute = True
+                panel.pos_x, panel.pos_y = x, y
+                panel.width, panel.height = 12, 3
+                style = Style()
+                style.color = 'white'
+                value = Text('0')
+                style.attach([Text('cpu%d' % len(self.values)), Newline(), value])
+                panel.attach(style)
+                body.attach(panel)
+                self.values.append((style, value))
+        self.document.attach(body)
+
+    def step(self, i):
+        for style, value in self.random.sample(self.values, max(len(self.values) // 10, 1)):
+            value.content = '%.1f%%' % (self.random.random() * 100)
+            style.color = self.random.choice(self.colors)
+
+
+class NestedScene(Scene):
+    'Blocks nested 200 deep, every 25th labelled and indented, and a counter in the innermost one.'
+    name = 'nested'
+    depth = 200
+
+    def build(self):
+        body = Block()
+        node = body
+        for i in range(self.depth):
+            child = Block()
+            if i % 25 == 0:
+                child.margin_left = 1
+                node.attach([Text('level %d' % i), Newline()])
+            node.attach(child)
+            node = child
+        self.leaf = node.attach(Text(''))
+        self.document.attach(body)
+
+    def step(self, i):
+        self.leaf.content = 'frame %d' % i
+
+
+scenes = [EditorScene, LogScene, DashboardScene, NestedScene]
+
+def run(scene, frames, differential):
+    '''Renders frames of a scene.
+
+    :returns: dict -- The frames per second, bytes per frame and peak traced bytes per frame'''
+    renderer = Renderer(scene.document)
+    h, w = scene.height, scene.width
+    renderer.render(h, w, differential=False)
+
+    out = 0
+    elapsed = 0
+    for i in range(frames):
+        scene.step(i)
+        t = time.perf_counter()
+        res = renderer.render(h, w, differential=differential)
+        elapsed += time.perf_counter() - t
+        out += len(res.encode('utf-8'))
+
+    # Memory is traced in separate frames, as tracing slows rendering down
+    peak = 0
+    n = max(frames // 10, 1)
+    for i in range(frames, frames + n):
+        scene.step(i)
+        tracemalloc.start()
+        renderer.render(h, w, differential=differential)
+        peak += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {'fps': frames / elapsed, 'bytes': out / frames, 'peak': peak / n}
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless render benchmark')
+    parser.add_argument('--frames', type=int, default=200, help='frames rendered per measurement')
+    parser.add_argument('--sizes', default='80x24,120x40,200x60', help='terminal sizes, as WIDTHxHEIGHT')
+    parser.add_argument('--scenes', default=','.join(s.name for s in scenes), help='scenes to run')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per result')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in size.split('x')) for size in args.sizes.split(',')]
+    selected = [s for s in scenes if s.name in args.scenes.split(',')]
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+
+    if not args.json:
+        print('%-10s %8s %-12s %10s %12s %14s' % ('scene', 'size', 'path', 'frames/s', 'bytes/frame', 'peak KB/frame'))
+    for cls in selected:
+        for width, height in sizes:
+            for path in ('full', 'differential'):
+                res = run(cls(height, width), args.frames, path == 'differential')
+                if args.json:
+                    res.update(scene=cls.name, width=width, height=height, path=path)
+                    print(json.dumps(res, sort_keys=True))
+                else:
+                    print('%-10s %8s %-12s %10.1f %12.1f %14.1f' % (
+                        cls.name, '%dx%d' % (width, height), path, res['fps'], res['bytes'],
+                        res['peak'] / 1024))
+                sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import re, unicodedata
+
+# Text made of printable ASCII only, where every character is one cell
+_simple = re.compile('[\x20-\x7e]*\\Z')
+
+_widths = {}
+
+def is_simple(text):
+    '''Check whether every character of text takes up exactly one cell
+
+    :param str text: The text
+    :returns: bool -- Whether the text is printable ASCII'''
+    return _simple.match(text) is not None
+
+def char_width(c):
+    '''Get the number of cells a character takes up
+
+    Characters that are wide or fullwidth in the East Asian width table take
+    two cells. Combining marks, format characters like zero width joiners, and
+    control characters take none. Anything else takes one.
+
+    :param str c: The character
+    :returns: int -- The width, 0, 1 or 2'''
+    try:
+        return _widths[c]
+    except KeyError:
+        pass
+    if unicodedata.category(c) in ('Mn', 'Me', 'Cf', 'Cc') or unicodedata.combining(c):
+        res = 0
+    elif unicodedata.east_asian_width(c) in ('W', 'F'):
+        res = 2
+    else:
+        res = 1
+    _widths[c] = res
+    return res
+
+def clusters(text):
+    '''Split text into the strings shown in a single cell, or a pair for wide characters.
+    Zero width characters are kept with the character before them, and dropped at the start.
+    Control characters other than tab are dropped. Characters with combining marks are
+    composed where Unicode has a single character for them.
+
+    :param str text: The text
+    :returns: list -- List of (string, width) tuples'''
+    res = []
+    for c in text:
+        w = char_width(c)
+        if w or c == '\t':
+            res.append([c, w])
+        elif res and res[-1][0] != '\t' and unicodedata.category(c) != 'Cc':
+            res[-1][0] += c
+    return [(unicodedata.normalize('NFC', s) if len(s) > 1 else s, w) for s, w in res]
+
+def text_width(text, tabstop=4):
+    '''Get the number of cells a single line of text takes up
+
+    :param str text: The text
+    :param int tabstop: The distance between tab stops
+    :returns: int -- The width'''
+    if is_simple(text):
+        return len(text)
+    x = 0
+    for s, w in clusters(text):
+        x += w if s != '\t' else tabstop - (x % tabstop)
+    return x
+
+
+class Wrap(object):
+    '''Text broken into rows of cells
+
+    Characters are placed from the starting column onwards, and the text
+    continues on the next row once a row is full. Wide characters that do not
+    fit at the end of a row are moved to the next one, and tabs advance to the
+    next tab stop.
+
+    cells holds a (string, column, width) tuple for every character that is
+    shown, and breaks the index into cells at which every row starts, with a
+    final entry for the end. end is the (column, row) the text leaves the
+    cursor at, relative to the row it started on.'''
+    def __init__(self, text, cx, width, tabstop):
+        '''Break text into rows
+
+        :param str text: The text
+        :param int cx: The column the text starts at
+        :param int width: The width of the rows
+        :param int tabstop: The distance between tab stops'''
+        self.key = (cx, width, tabstop)
+        self.cells = cells = []
+        self.breaks = breaks = [0]
+
+        # Boxes without room are written to on a single row, like plain text
+        wrap = 0 <= cx < width
+        for s, w in clusters(text):
+            if s == '\t':
+                cx += tabstop - (cx % tabstop)
+            else:
+                if wrap and cx + w > width:
+                    breaks.append(len(cells))
+                    cx = 0
+                cells.append((s, cx, w))
+                cx += w
+            if wrap and cx >= width:
+                breaks.append(len(cells))
+                cx = 0
+        self.end = (cx, len(breaks) - 1)
+        breaks.append(len(cells))
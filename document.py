@@ -1,3 +1,6 @@
+import re
+from rope import Rope
+
 class Event(object):
     def __init__(self, _type, args, flags):
         self._type = _type
@@ -19,17 +22,16 @@ class Event(object):
 class NodeError(RuntimeError):
     pass
 
-class Node(object):
-    type = 'none'
-    def __init__(self):
-        # Internal attributes
-        self.children = []
-        self.updatehook = None
-        self.parent = None
-
-        self.id = None
+class LayoutStyle(object):
+    '''The style attributes positioning a node.
+    Nodes share a single default instance until one of their attributes is set,
+    and instances are never changed once in use, but replaced by a changed
+    copy. The renderer can therefore tell that the style of a node stayed the
+    same from its LayoutStyle being the same instance.'''
+    __slots__ = ('absolute', 'width', 'height', 'pos_x', 'pos_y',
+                 'margin_left', 'margin_right', 'margin_top', 'margin_bottom')
 
-        # Style attributes
+    def __init__(self):
         self.absolute = False
         self.width = None
         self.height = None
@@ -41,8 +43,80 @@ class Node(object):
         self.margin_top = 0
         self.margin_bottom = 0
 
-        # Random user storage
-        self.data = {}
+    def copy(self):
+        res = LayoutStyle.__new__(LayoutStyle)
+        for name in self.__slots__:
+            setattr(res, name, getattr(self, name))
+        return res
+
+_default_layout = LayoutStyle()
+
+def _layout_attribute(name):
+    'Returns a property for a style attribute, replacing the LayoutStyle of the node and notifying when it changes'
+    def get(self):
+        return getattr(self._layout, name)
+    def set(self, value):
+        if getattr(self._layout, name) == value:
+            return
+        layout = self._layout.copy()
+        setattr(layout, name, value)
+        self._layout = layout
+        self._notify()
+    return property(get, set)
+
+# Shared by all nodes that cannot have children, and all without classes
+_no_children = ()
+_no_classes = frozenset()
+
+class Node(object):
+    type = 'none'
+    __slots__ = ('children', 'updatehook', 'parent', '_top', '_id', '_classes',
+                 '_dirty', '_child_dirty', '_layout', '_data')
+    _leaf = False
+
+    def __init__(self):
+        # Internal attributes
+        self.children = _no_children if self._leaf else []
+        self.updatehook = None
+        self.parent = None
+
+        # The root of the tree the node is part of, which is the document once
+        # attached to one. Kept up to date for whole subtrees by attach/detach.
+        self._top = self
+
+        # Indexed by the document the node is attached to
+        self._id = None
+        self._classes = _no_classes
+
+        # Dirty tracking. _dirty means the node itself changed, _child_dirty
+        # that some descendant did. The renderer clears both after a frame.
+        self._dirty = True
+        self._child_dirty = False
+
+        # Style attributes
+        self._layout = _default_layout
+
+        # Random user storage, created when first used
+        self._data = None
+
+    absolute = _layout_attribute('absolute')
+    width = _layout_attribute('width')
+    height = _layout_attribute('height')
+    pos_x = _layout_attribute('pos_x')
+    pos_y = _layout_attribute('pos_y')
+    margin_left = _layout_attribute('margin_left')
+    margin_right = _layout_attribute('margin_right')
+    margin_top = _layout_attribute('margin_top')
+    margin_bottom = _layout_attribute('margin_bottom')
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = {}
+        return self._data
+    @data.setter
+    def data(self, value):
+        self._data = value
 
     def __len__(self):
         return self.children.__len__()
@@ -53,13 +127,70 @@ class Node(object):
     def __eq__(self, other):
         return id(self) == id(other)
 
+    @property
+    def id(self):
+        return self._id
+    @id.setter
+    def id(self, value):
+        doc = self._document()
+        if doc is not None:
+            doc._unindex(self)
+        self._id = value
+        if doc is not None:
+            doc._index(self)
+
+    @property
+    def classes(self):
+        'The set of class names of the node, used by selector queries'
+        return self._classes
+    @classes.setter
+    def classes(self, value):
+        doc = self._document()
+        if doc is not None:
+            doc._unindex(self)
+        self._classes = frozenset(value)
+        if doc is not None:
+            doc._index(self)
+
     def top(self):
-        if self.parent is None:
-            return self
-        return self.parent.top()
+        return self._top
+
+    def _document(self):
+        'Returns the document the node is attached to, if any'
+        t = self._top
+        return t if isinstance(t, Document) else None
+
+    def walk(self):
+        'Iterates over the node and all of its descendants, in document order'
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def _mark_dirty(self):
+        self._dirty = True
+        p = self.parent
+        while p is not None and not p._child_dirty:
+            p._child_dirty = True
+            p = p.parent
+
+        # Every block above records the child leading here, to find the
+        # changes without going through all of its children
+        node, p = self, self.parent
+        while p is not None:
+            if p.type == 'block':
+                if node in p._changed:
+                    break
+                p._changed.add(node)
+            node, p = p, p.parent
+
+    def _children_changed(self, index):
+        'Called when a child is attached at or detached from index'
 
     def _notify(self):
-        t = self.top()
+        self._mark_dirty()
+        t = self._top
         if t.updatehook is not None:
             t.updatehook(self)
 
@@ -78,8 +209,16 @@ class Node(object):
         o.parent = self
         if index is None:
             self.children.append(o)
+            self._children_changed(len(self.children) - 1)
         else:
             self.children.insert(index, o)
+            size = len(self.children) - 1
+            self._children_changed(min(index, size) if index >= 0 else max(size + index, 0))
+        o._dirty = True
+        if self.type == 'block':
+            self._changed.add(o)
+        _retop(o, self._top)
+        self._mark_dirty()
         if _notify: self._notify()
         return o
 
@@ -102,8 +241,12 @@ class Node(object):
             if o.parent is not self:
                 raise NodeError('Node not attached')
 
-        self.children.remove(o)
+        _retop(o, o)
+        index = self.children.index(o)
+        del self.children[index]
+        self._children_changed(index)
         o.parent = None
+        self._mark_dirty()
         if _notify: self._notify()
         return o
 
@@ -112,11 +255,70 @@ class Node(object):
             cb(child)
 
 
+def _retop(node, top):
+    'Points every node of a subtree at the root of the tree it is now part of, moving it between document indexes'
+    old = node._top
+    leaving = old if isinstance(old, Document) else None
+    joining = top if isinstance(top, Document) else None
+    for n in node.walk():
+        if leaving is not None:
+            leaving._unindex(n)
+        n._top = top
+        if joining is not None:
+            joining._index(n)
+
+
 class Block(Node):
     type = 'block'
+    __slots__ = ('_scroll', '_box', '_rect', '_bounds', '_layout_key', '_changed', '_flow_rows',
+                 '_flow_cols', '_flow_fixed', '_flow_key', '_flow_valid', '_flow_index')
+
+    def __init__(self):
+        super(Block, self).__init__()
+        self._scroll = 0
+
+        # Layout cache, maintained by the renderer: the box the block was
+        # last laid out in, its clipped cell rectangle, the rectangle
+        # covering everything its subtree painted, and the box of its parent,
+        # the cursor position and the LayoutStyle the box was computed from.
+        self._box = None
+        self._rect = None
+        self._bounds = None
+        self._layout_key = None
+
+        # The children leading to nodes that changed since the last frame
+        self._changed = set()
+
+        # Flow cache, maintained by the renderer: the cursor position after
+        # each child, the indices of the children that paint anything but
+        # text flowing from the cursor, the (width, tabstop) it was measured
+        # with, how many leading entries are still valid, and the index of
+        # every measured child by id.
+        # The lists are created when the block is first laid out.
+        self._flow_rows = None
+        self._flow_cols = None
+        self._flow_fixed = None
+        self._flow_key = None
+        self._flow_valid = 0
+        self._flow_index = None
+
+    @property
+    def scroll(self):
+        'The number of rows the content of the block is scrolled up by'
+        return self._scroll
+    @scroll.setter
+    def scroll(self, value):
+        self._scroll = max(value, 0)
+        self._notify()
+
+    def _children_changed(self, index):
+        self._flow_valid = min(self._flow_valid, index)
 
 
 class BachelorNode(Node):
+    __slots__ = ()
+    _leaf = True
+
     def attach(self, o):
         raise NodeError('Node is not mature enough to become a parent')
 
@@ -126,10 +328,16 @@ class BachelorNode(Node):
 
 class Text(BachelorNode):
     type = 'text'
+    __slots__ = ('_content', '_wrap')
+
     def __init__(self, content=''):
         super(Text, self).__init__()
         self._content = content
 
+        # Wrap cache, maintained by the renderer: the content broken into
+        # rows for the last column, width and tabstop it was laid out with
+        self._wrap = None
+
     @property
     def content(self):
         return self._content
@@ -137,24 +345,62 @@ class Text(BachelorNode):
     @content.setter
     def content(self, value):
         self._content = value
+        self._wrap = None
+        self._notify()
+
+class TextBuffer(BachelorNode):
+    '''A text node for large, frequently edited text, kept in a Rope.
+    Only the lines from top_line down to the bottom of the box are rendered, and lines longer than the box are cut off.'''
+    type = 'textbuffer'
+    __slots__ = ('rope', '_top_line')
+
+    def __init__(self, content=''):
+        super(TextBuffer, self).__init__()
+        self.rope = Rope(content)
+        self._top_line = 0
+
+    @property
+    def content(self):
+        return self.rope.text()
+
+    @property
+    def top_line(self):
+        return self._top_line
+    @top_line.setter
+    def top_line(self, value):
+        self._top_line = value
+        self._notify()
+
+    def insert(self, pos, text):
+        self.rope.insert(pos, text)
+        self._notify()
+
+    def delete(self, pos, length):
+        self.rope.delete(pos, length)
         self._notify()
 
 class Newline(BachelorNode):
     type = 'newline'
+    __slots__ = ()
 
 
 class Tab(BachelorNode):
     type = 'tab'
+    __slots__ = ()
 
 
 class Style(Node):
     type = 'style'
+    __slots__ = ('_color', '_bright', '_bg_color', '_bg_bright', '_bold', '_underline')
+
     def __init__(self):
         super(Style, self).__init__()
         self._color = None
         self._bright = False
         self._bg_color = None
         self._bg_bright = False
+        self._bold = None
+        self._underline = None
 
     @property
     def color(self):
@@ -188,10 +434,29 @@ class Style(Node):
         self._bg_bright = value
         self._notify()
 
+    @property
+    def bold(self):
+        return self._bold
+    @bold.setter
+    def bold(self, value):
+        self._bold = value
+        self._notify()
+
+    @property
+    def underline(self):
+        return self._underline
+    @underline.setter
+    def underline(self, value):
+        self._underline = value
+        self._notify()
+
 class StyleOverride(Style):
     type = 'styleoverride'
+    __slots__ = ('_rect',)
+
     def __init__(self):
         super(StyleOverride, self).__init__()
+        self._rect = None
 
     def attach(self, o):
         raise NodeError('Node is not mature enough to become a parent')
@@ -200,16 +465,82 @@ class StyleOverride(Style):
         raise NodeError('Node is not mature enough to lose a child')
 
 
+_compound = re.compile(r'([\w-]+|\*)?((?:[.#][\w-]+)*)$')
+_selectors = {}
+
+def _parse_selector(selector):
+    '''Parse a selector into a list of (combinator, type, ids, classes) steps, from left to right.
+    The combinator joining a step to the one before it is ' ' for any ancestor or '>' for the parent.'''
+    try:
+        return _selectors[selector]
+    except KeyError:
+        pass
+    steps = []
+    combinator = ' '
+    for token in selector.replace('>', ' > ').split():
+        if token == '>':
+            combinator = '>'
+            continue
+        m = _compound.match(token)
+        if m is None or not token:
+            raise ValueError('Invalid selector: %r' % selector)
+        _type = m.group(1) if m.group(1) != '*' else None
+        parts = re.findall(r'([.#])([\w-]+)', m.group(2))
+        ids = [v for k, v in parts if k == '#']
+        classes = frozenset(v for k, v in parts if k == '.')
+        steps.append((combinator, _type, ids, classes))
+        combinator = ' '
+    if not steps or combinator == '>':
+        raise ValueError('Invalid selector: %r' % selector)
+    res = _selectors[selector] = steps
+    return res
+
+def _matches(node, step):
+    combinator, _type, ids, classes = step
+    return ((_type is None or node.type == _type) and
+            all(node.id == i for i in ids) and classes <= node.classes)
+
+def _matches_path(node, steps, i):
+    'Checks whether the ancestors of a node matching step i match the steps before it'
+    if i == 0:
+        return True
+    combinator = steps[i][0]
+    p = node.parent
+    while p is not None and not isinstance(p, Document):
+        if _matches(p, steps[i-1]) and _matches_path(p, steps, i-1):
+            return True
+        if combinator == '>':
+            break
+        p = p.parent
+    return False
+
+
 class Document(Node):
-    'The document is a special node that may not be used as child'
+    '''The document is a special node that may not be used as child
+
+    Every node attached to the document is indexed by its id, its class names
+    and its type, so looking nodes up does not walk the tree. If several nodes
+    share an id, the one attached or given the id last is found.'''
+    # The size of the screen, which unlike the size of other nodes is not a
+    # style attribute, so plain attributes shadow the properties of Node
+    width = 0
+    height = 0
+
     def __init__(self):
+        self._ids = {}
+        self._by_class = {}
+        self._by_type = {}
+        self.updatehook = None
+        self._top = self
+        self._layout = _default_layout
         self.body = None
         self.width = 0
         self.height = 0
-        self._scroll = 0
         self.listeners = []
         self.prerendered = []
         self.dependencies = {}
+        self._dirty = True
+        self._child_dirty = False
 
     @property
     def parent(self):
@@ -217,9 +548,9 @@ class Document(Node):
         return None
 
     def scroll(self, y):
-        self._scroll += y
-        if self._scroll < 0:
-            self._scroll = 0
+        'Scrolls the body by y rows. Only a Block body scrolls, other bodies are left as they are.'
+        if self.body is not None and self.body.type == 'block':
+            self.body.scroll += y
 
     def setdimensions(self, height=None, width=None):
         if self.height is not None:
@@ -244,13 +575,88 @@ class Document(Node):
             self.detach()
         body.parent = self
         self.body = body
+        _retop(body, self)
 
     def detach(self):
+        _retop(self.body, self.body)
         self.body.parent = None
         self.body = None
 
+    def _index(self, node):
+        if node._id is not None:
+            self._ids[node._id] = node
+        for name in node._classes:
+            self._by_class.setdefault(name, set()).add(node)
+        self._by_type.setdefault(node.type, set()).add(node)
+
+    def _unindex(self, node):
+        if node._id is not None and self._ids.get(node._id) is node:
+            del self._ids[node._id]
+        for name in node._classes:
+            self._by_class[name].discard(node)
+        self._by_type[node.type].discard(node)
+
+    @staticmethod
+    def _within(node, body):
+        while node is not None:
+            if node is body:
+                return True
+            node = node.parent
+        return False
+
     def getbyid(self, _id, body=None):
-        if body is None: body = self.body
-        for child in body.children:
-            if child.id == _id:
-                return child
+        '''Get the node with an id
+
+        :param _id: The id
+        :param Node body: The node to search below, or None for the whole document
+        :returns: Node -- The node, or None if there is none'''
+        node = self._ids.get(_id)
+        if node is not None and body is not None and not self._within(node.parent, body):
+            return None
+        return node
+
+    def getbyclass(self, name):
+        '''Get the nodes with a class name, in no particular order
+
+        :param str name: The class name
+        :returns: list -- The nodes'''
+        return list(self._by_class.get(name, ()))
+
+    def getbytype(self, _type):
+        '''Get the nodes of a type, in no particular order
+
+        :param str _type: The type, like 'block' or 'text'
+        :returns: list -- The nodes'''
+        return list(self._by_type.get(_type, ()))
+
+    def query(self, selector, body=None):
+        '''Get the nodes matching a selector, in no particular order
+
+        Selectors are made of steps like type, #id, .class or any combination,
+        such as block.status, separated by spaces to match descendants or by >
+        to match children. * matches any type.
+
+        Candidates are taken from the index that narrows them down the most,
+        so queries naming an id or a rare class do not walk the tree.
+
+        :param str selector: The selector
+        :param Node body: The node to search below, or None for the whole document
+        :returns: list -- The nodes'''
+        steps = _parse_selector(selector)
+        combinator, _type, ids, classes = steps[-1]
+        if ids:
+            node = self._ids.get(ids[0])
+            candidates = [node] if node is not None else []
+        else:
+            sets = [self._by_class.get(name, ()) for name in classes]
+            if _type is not None:
+                sets.append(self._by_type.get(_type, ()))
+            if sets:
+                candidates = min(sets, key=len)
+            elif self.body is not None:
+                candidates = self.body.walk()
+            else:
+                candidates = []
+        return [n for n in candidates
+                if _matches(n, steps[-1]) and _matches_path(n, steps, len(steps) - 1) and
+                (body is None or self._within(n.parent, body))]
@@ -1,8 +1,9 @@
 from system import *
-import sys, pdb
+from cellwidth import text_width
+import sys, pdb, re
 
 class View(object):
-    def __init__(self, system):
+    def __init__(self, system, content=''):
         self.system = system
         self.document = system.getdocument()
         self.top = self.document.top()
@@ -16,6 +17,8 @@ class View(object):
         self.cursor_x = 0
         self.cursor_y = 0
         self.scroll = 1
+        self.pos = 0
+        self.tabstop = 4
 
         self.setup_cursor(self.cursor)
         self.setup_modeline(self.bottom)
@@ -27,7 +30,7 @@ class View(object):
         self.editor.attach(self.cursor)
 
         self.document.attach(self.block)
-        self.current = self.editor.attach(Text(''))
+        self.buffer = self.editor.attach(TextBuffer(content))
 
         self.document.attachevent(self.callback)
 
@@ -77,78 +80,83 @@ class View(object):
         self.bottom.attach(Text(text))
 
     def update_cursor(self):
+        rope = self.buffer.rope
+        line = rope.line_of(self.pos)
+        start = rope.line_start(line)
+
+        # Scroll the cursor line into view
+        top = self.buffer.top_line
+        rows = self.document.height - 1
+        if line < top:
+            top = line
+        elif line >= top + rows:
+            top = line - rows + 1
+        if top != self.buffer.top_line:
+            self.buffer.top_line = top
+            self.scroll = top + 1
+            self.update_gutter(self.scroll)
+
+        self.cursor_x = text_width(rope.text(start, self.pos), self.tabstop)
+        self.cursor_y = line - top
         self.cursor.margin_left = self.cursor_x
         self.cursor.margin_top = self.cursor_y
         self.cursor._notify()
 
-    def up(self):
-        self.cursor_y -= 1
-        if self.cursor_y < 0:
-            self.scroll -= 1
-            self.cursor_y = 0
+    def move_line(self, n):
+        rope = self.buffer.rope
+        line = rope.line_of(self.pos)
+        target = min(max(line + n, 0), rope.line_count() - 1)
+        if target != line:
+            col = self.pos - rope.line_start(line)
+            start = rope.line_start(target)
+            self.pos = min(start + col, rope.line_end(target))
         self.update_cursor()
-        self.update_gutter(self.scroll)
+
+    def up(self):
+        self.move_line(-1)
 
     def down(self):
-        self.cursor_y += 1
-        if self.cursor_y >= self.document.height-1:
-            self.scroll += 1
-            self.cursor_y = self.document.height-2
-        self.update_cursor()
-        self.update_gutter(self.scroll)
+        self.move_line(1)
 
     def back(self):
-        self.cursor_x -= 1
-        if self.cursor_x <= 0:
-            if self.cursor_y > 0:
-                self.up()
-                self.cursor_x = self.document.width-self.gutter.width
-            else:
-                self.cursor_x = 0
+        self.pos = max(self.pos - 1, 0)
         self.update_cursor()
 
     def forward(self):
-        self.cursor_x += 1
-        if self.cursor_x >= self.document.width-self.gutter.width:
-            if self.cursor_y < self.document.height-2:
-                self.down()
-                self.cursor_x = 0
-            else:
-                self.cursor_x = self.document.width-5
+        self.pos = min(self.pos + 1, len(self.buffer.rope))
         self.update_cursor()
 
     def write(self, c):
-        self.current.content += c
-        # if c == ' ':
-        #     self.current = self.editor.attach(Text(''))
-        self.cursor_x += 1
+        self.buffer.insert(self.pos, c)
+        self.pos += len(c)
         self.update_cursor()
 
+    def newline(self):
+        self.write('\n')
+
+    def tab(self):
+        self.write('\t')
+
+    def paste(self, text):
+        self.write(re.sub('\r\n?', '\n', text))
+
     def backspace(self):
-        if self.current.type != 'text' or self.current.content == '':
-            self.editor.detach(self.current)
-            self.current = None
-            while self.current is None or self.current.type not in ('text', 'newline', 'tab'):
-                try:
-                    self.editor.detach(index=-1)
-                    self.current = self.editor.children[-1]
-                except:
-                    self.current = self.editor.attach(Text(''))
-                    break
-        else:
-            self.current.content = self.current.content[:-1]
+        if self.pos > 0:
+            self.buffer.delete(self.pos - 1, 1)
+            self.pos -= 1
+            self.update_cursor()
 
     def callback(self, e):
         if e.type == 'draw':
             self.write(e.args[0])
         elif e.type == 'delete':
             self.backspace()
+        elif e.type == 'paste':
+            self.paste(e.args[0])
         elif e.type == 'linefeed':
-            self.editor.attach(Newline())
-            self.current = self.editor.attach(Text(''))
+            self.newline()
         elif e.type == 'tab':
-            self.editor.attach(Tab())
-            self.current = self.editor.attach(Text(''))
+            self.tab()
         elif e.type == 'cursor_down':
             self.down()
         elif e.type == 'cursor_up':
@@ -164,9 +172,13 @@ class View(object):
             self.system.render(differential=False)
 
 
-s = System()
+s = System(adaptive=True)
 try:
-    v = View(s)
+    content = ''
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            content = f.read()
+    v = View(s, content)
     s.start()
 except KeyboardInterrupt:
     s.cleanup()
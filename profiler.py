@@ -0,0 +1,126 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json, time
+from collections import deque
+
+clock = getattr(time, 'monotonic', time.time)
+
+def describe(obj):
+    '''Describe a node the way a selector would match it, like Text#status.dim
+
+    :param Node obj: The node, or None
+    :returns: str -- The description, or None'''
+    if obj is None:
+        return None
+    res = type(obj).__name__
+    _id = getattr(obj, 'id', None)
+    if _id is not None:
+        res += '#%s' % _id
+    for c in sorted(getattr(obj, 'classes', ())):
+        res += '.%s' % c
+    return res
+
+
+class Profiler(object):
+    '''Records what every frame spent its time on
+
+    A frame starts with begin and ends with end. In between, mark records the
+    time since the previous mark as spent on the named phase, and count adds to
+    a named counter, like the number of cells that changed. Notifications are
+    counted towards the next frame, and the first node to notify is kept as
+    the trigger of that frame.
+
+    The last frames are kept for stats, and every frame can also be written to
+    a log as a line of JSON.'''
+    def __init__(self, log=None, window=120):
+        '''Create a profiler
+
+        :param file log: File to write a JSON line per frame to, or None
+        :param int window: The number of frames kept for stats'''
+        self.log = log
+        self.frames = deque(maxlen=window)
+        self.frame = None
+        self.last = None
+        self.notifications = 0
+        self.trigger = None
+
+    def notify(self, obj):
+        '''Count a notification towards the next frame
+
+        :param Node obj: The node that notified'''
+        if not self.notifications:
+            self.trigger = describe(obj)
+        self.notifications += 1
+
+    def begin(self):
+        'Start a frame, taking over the notifications since the last one'
+        self.last = clock()
+        self.frame = {
+            'time': self.last,
+            'trigger': self.trigger,
+            'notifications': self.notifications,
+            'phases': {},
+            'cells': 0,
+            'bytes': 0,
+        }
+        self.notifications = 0
+        self.trigger = None
+
+    def mark(self, phase):
+        '''Record the time since the previous mark as spent on a phase
+
+        :param str phase: The name of the phase'''
+        if self.frame is None:
+            return
+        now = clock()
+        phases = self.frame['phases']
+        phases[phase] = phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def count(self, name, n):
+        '''Add to a counter of the frame
+
+        :param str name: The name of the counter
+        :param int n: The amount to add'''
+        if self.frame is not None:
+            self.frame[name] = self.frame.get(name, 0) + n
+
+    def end(self):
+        '''End the frame, and write it to the log
+
+        :returns: dict -- The frame'''
+        frame, self.frame = self.frame, None
+        if frame is None:
+            return None
+        frame['total'] = self.last - frame['time']
+        self.frames.append(frame)
+        if self.log is not None:
+            self.log.write(json.dumps(frame, sort_keys=True) + '\n')
+            self.log.flush()
+        return frame
+
+    def stats(self):
+        '''Summarize the frames kept
+
+        Times are in seconds, and everything else is a mean per frame, except
+        for the maximum frame time and the frames rendered per second.
+
+        :returns: dict -- The summary, or None if no frame has been rendered'''
+        frames = self.frames
+        n = len(frames)
+        if not n:
+            return None
+        span = frames[-1]['time'] - frames[0]['time']
+        phases = {}
+        for frame in frames:
+            for phase, t in frame['phases'].items():
+                phases[phase] = phases.get(phase, 0) + t
+        return {
+            'frames': n,
+            'fps': (n - 1) / span if span > 0 else None,
+            'total': sum(f['total'] for f in frames) / n,
+            'max': max(f['total'] for f in frames),
+            'phases': dict((phase, t / n) for phase, t in phases.items()),
+            'notifications': sum(f['notifications'] for f in frames) / n,
+            'cells': sum(f['cells'] for f in frames) / n,
+            'bytes': sum(f['bytes'] for f in frames) / n,
+        }
@@ -0,0 +1,239 @@
+import random
+
+class _Piece(object):
+    'A node of the rope tree, holding a chunk of text'
+    def __init__(self, text):
+        self.text = text
+        self.left = None
+        self.right = None
+        self.priority = random.random()
+        self.size = len(text)
+        self.lines = text.count('\n')
+
+def _size(n):
+    return n.size if n is not None else 0
+
+def _lines(n):
+    return n.lines if n is not None else 0
+
+def _update(n):
+    n.size = _size(n.left) + len(n.text) + _size(n.right)
+    n.lines = _lines(n.left) + n.text.count('\n') + _lines(n.right)
+
+def _merge(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority > b.priority:
+        a.right = _merge(a.right, b)
+        _update(a)
+        return a
+    b.left = _merge(a, b.left)
+    _update(b)
+    return b
+
+def _split(n, pos):
+    'Splits a tree into the first pos characters and the rest'
+    if n is None:
+        return None, None
+    ls = _size(n.left)
+    if pos <= ls:
+        left, n.left = _split(n.left, pos)
+        _update(n)
+        return left, n
+    if pos >= ls + len(n.text):
+        n.right, right = _split(n.right, pos - ls - len(n.text))
+        _update(n)
+        return n, right
+    # Split inside the chunk
+    k = pos - ls
+    tail = _Piece(n.text[k:])
+    n.text = n.text[:k]
+    tail.right, n.right = n.right, None
+    _update(tail)
+    _update(n)
+    return n, tail
+
+def _nth_newline(n, k):
+    'Returns the offset of the k-th newline of a tree, counting from 1'
+    offset = 0
+    while n is not None:
+        ll = _lines(n.left)
+        if k <= ll:
+            n = n.left
+            continue
+        k -= ll
+        offset += _size(n.left)
+        count = n.text.count('\n')
+        if k <= count:
+            i = -1
+            for _ in range(k):
+                i = n.text.index('\n', i + 1)
+            return offset + i
+        k -= count
+        offset += len(n.text)
+        n = n.right
+    raise IndexError('No such line')
+
+def _collect(n, offset, start, end, res):
+    'Appends the text of a tree between start and end to res'
+    if n is None or offset >= end or offset + n.size <= start:
+        return
+    _collect(n.left, offset, start, end, res)
+    own = offset + _size(n.left)
+    if own < end and own + len(n.text) > start:
+        res.append(n.text[max(start - own, 0):end - own])
+    _collect(n.right, own + len(n.text), start, end, res)
+
+
+class Rope(object):
+    '''Rope of text
+
+    The text is kept in chunks of at most MAX_CHUNK characters, in a
+    randomized balanced tree (a treap) where every node knows the length and
+    the number of newlines of its subtree. Inserting, deleting, and finding
+    lines by number or by offset take O(log n).'''
+    MAX_CHUNK = 512
+
+    def __init__(self, text=''):
+        self.root = None
+        if text:
+            self.insert(0, text)
+
+    def __len__(self):
+        return _size(self.root)
+
+    def line_count(self):
+        'Returns the number of lines. An empty rope, or one ending in a newline, ends with an empty line.'
+        return _lines(self.root) + 1
+
+    def _insert_chunk(self, n, pos, text):
+        'Inserts text into an existing chunk if it fits. Returns whether it did.'
+        if n is None:
+            return False
+        ls = _size(n.left)
+        if pos < ls:
+            done = self._insert_chunk(n.left, pos, text)
+        elif pos <= ls + len(n.text):
+            if len(n.text) + len(text) > self.MAX_CHUNK:
+                return False
+            k = pos - ls
+            n.text = n.text[:k] + text + n.text[k:]
+            done = True
+        else:
+            done = self._insert_chunk(n.right, pos - ls - len(n.text), text)
+        if done:
+            _update(n)
+        return done
+
+    def insert(self, pos, text):
+        '''Insert text
+
+        :param int pos: The offset to insert at
+        :param str text: The text to insert'''
+        if not 0 <= pos <= len(self):
+            raise IndexError('Insert position outside of rope')
+        if not text or self._insert_chunk(self.root, pos, text):
+            return
+        middle = None
+        for i in range(0, len(text), self.MAX_CHUNK):
+            middle = _merge(middle, _Piece(text[i:i+self.MAX_CHUNK]))
+        left, right = _split(self.root, pos)
+        self.root = _merge(_merge(left, middle), right)
+
+    def _delete_chunk(self, n, pos, length):
+        'Deletes text inside a single chunk, if it leaves the chunk non-empty. Returns whether it did.'
+        if n is None:
+            return False
+        ls = _size(n.left)
+        end = ls + len(n.text)
+        if pos < ls:
+            if pos + length > ls:
+                return False
+            done = self._delete_chunk(n.left, pos, length)
+        elif pos >= end:
+            done = self._delete_chunk(n.right, pos - end, length)
+        else:
+            if pos + length > end or length == len(n.text):
+                return False
+            k = pos - ls
+            n.text = n.text[:k] + n.text[k+length:]
+            done = True
+        if done:
+            _update(n)
+        return done
+
+    def delete(self, pos, length):
+        '''Delete text
+
+        :param int pos: The offset of the first character to delete
+        :param int length: The number of characters to delete'''
+        length = min(length, len(self) - pos)
+        if pos < 0 or length < 0:
+            raise IndexError('Delete range outside of rope')
+        if length == 0 or self._delete_chunk(self.root, pos, length):
+            return
+        left, rest = _split(self.root, pos)
+        middle, right = _split(rest, length)
+        self.root = _merge(left, right)
+
+    def text(self, start=0, end=None):
+        '''Get text
+
+        :param int start: The offset of the first character
+        :param int end: The offset after the last character, or None for the end
+        :returns: str -- The text'''
+        if end is None:
+            end = len(self)
+        res = []
+        _collect(self.root, 0, start, end, res)
+        return ''.join(res)
+
+    def line_start(self, line):
+        '''Get the offset a line starts at
+
+        :param int line: The line number, counting from 0
+        :returns: int -- The offset'''
+        if line == 0:
+            return 0
+        return _nth_newline(self.root, line) + 1
+
+    def line_end(self, line):
+        '''Get the offset a line ends at, which is that of its newline, if any
+
+        :param int line: The line number, counting from 0
+        :returns: int -- The offset'''
+        if line + 1 >= self.line_count():
+            if line + 1 > self.line_count():
+                raise IndexError('No such line')
+            return len(self)
+        return _nth_newline(self.root, line + 1)
+
+    def line(self, line):
+        '''Get the text of a line, without its newline
+
+        :param int line: The line number, counting from 0
+        :returns: str -- The text'''
+        return self.text(self.line_start(line), self.line_end(line))
+
+    def line_of(self, pos):
+        '''Get the line an offset is on
+
+        :param int pos: The offset
+        :returns: int -- The line number, counting from 0'''
+        line = 0
+        n = self.root
+        while n is not None:
+            ls = _size(n.left)
+            if pos <= ls:
+                n = n.left
+                continue
+            line += _lines(n.left)
+            pos -= ls
+            if pos <= len(n.text):
+                return line + n.text.count('\n', 0, pos)
+            line += n.text.count('\n')
+            pos -= len(n.text)
+            n = n.right
+        return line
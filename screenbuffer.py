@@ -1,9 +1,58 @@
+from array import array
+from itertools import count
+from styles import styles
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# Row version stamps. Every modification of a row gives it a fresh stamp, so
+# two rows carrying the same stamp are known to be identical. Stamp 0 is
+# reserved for blank rows.
+_stamps = count(1)
+
+_BLANK = ord(' ')
+
+# The right half of a wide character is stored as a continuation cell, which
+# is not printed. Strings of more than one code point, like characters with
+# combining marks, are interned and stored as codes from _CLUSTER upwards.
+_WIDE = 0
+_CLUSTER = 0x110000
+_clusters = []
+_cluster_ids = {}
+
+def _code(val):
+    'Returns the code stored for the content of a cell, the empty string meaning a continuation cell'
+    if len(val) == 1:
+        return ord(val)
+    if not val:
+        return _WIDE
+    try:
+        return _cluster_ids[val]
+    except KeyError:
+        _cluster_ids[val] = _CLUSTER + len(_clusters)
+        _clusters.append(val)
+        return _cluster_ids[val]
+
+def _char(code):
+    'Returns the content of a cell as printed'
+    if code < _CLUSTER:
+        return unichr(code) if code != _WIDE else ''
+    return _clusters[code - _CLUSTER]
+
 class ScreenBuffer(object):
     '''Screen buffer
 
     Use of this screen buffer allows for optimized differential rendition of the screen, given the previously rendered screen object.
 
-    Optimized rendition is enabled when compile is given a previous screen object, as it enables differential rendition. During this type of partial rendering, a lot of cursor moves can occur. This is optimized by calculating the tradeoff of issuing a cursor-move, compared to just rendering the characters in between. This makes this renderer very bandwidth efficient.'''
+    Optimized rendition is enabled when compile is given a previous screen object, as it enables differential rendition. During this type of partial rendering, a lot of cursor moves can occur. This is optimized by calculating the exact cost of the possible cursor moves, compared to just rendering the characters in between. This makes this renderer very bandwidth efficient.
+
+    Runs of blank cells are erased with EL or ECH rather than printed, when that is shorter. If use_rep is set, runs of a repeated character are emitted with REP, which not all terminals support.
+
+    Cells are stored as parallel arrays per row: code points, style IDs from the shared StyleTable, and z-index. Wide characters take up two cells, the right one being a continuation cell that is never printed by itself. A buffer can be reset or overwritten with the content of another buffer in place, so renderers can reuse the same memory frame after frame.'''
+    use_rep = False
+
     def __init__(self, height, width):
         '''Initialize a screen buffer of height * width
 
@@ -11,77 +60,269 @@ class ScreenBuffer(object):
         :param int width: The width of the screen buffer'''
         self._height = height
         self._width = width
-        self._lines = [[(' ', None, None, -1) for y in range(width)] for i in range(height)]
-        self._prev_modes = (None, None)
+        self._chars = [array('I', [_BLANK]) * width for i in range(height)]
+        self._styles = [array('I', [0]) * width for i in range(height)]
+        self._z = [array('i', [-1]) * width for i in range(height)]
+        self._versions = [0] * height
+        self._prev_style = 0
+
+    def _error(self, x, y, op):
+        m = None
+        if y >= len(self._chars):
+            m = 'Attempt to %s row outside of screen bounds' % op
+        elif x >= len(self._chars[y]):
+            m = 'Attempt to %s column outside of screen bounds' % op
+        return IndexError(m)
 
-    def set(self, x, y, val=None, fg=None, bg=None, z_index=0):
+    def set(self, x, y, val=None, style=0, z_index=0, width=1):
         '''Set a cell in the screen buffer
 
         Only the parameters provided will be sat for the cell. All other properties will be inherited from a previous set or a set of lower z_index
 
+        A wide character is set with a width of 2, taking up the cell to its right as a continuation cell. Both cells take the character or neither does, as half of one cannot be printed. Overwriting either half of a wide character blanks the other half.
+
         :param int x: The x coordinate
         :param int y: The y coordinate
-        :param str val: The value to set
-        :param str fg: The foreground mode
-        :param str bg: The background mode'''
+        :param str val: The value to set, one character with any combining marks
+        :param int style: The style ID, whose set attributes are applied to the cell
+        :param int z_index: The z-index
+        :param int width: The number of cells the value takes up, 1 or 2'''
         try:
-            oval, ofg, obg, oz_index = self._lines[y][x]
-            if z_index >= oz_index:
-                if val is not None:
-                    oval = val
-                if fg is not None:
-                    ofg = fg
-                if bg is not None:
-                    obg = bg
-            else:
-                if (oval is None or oval == ' ') and val is not None:
-                    oval = val
-                if ofg is None and fg is not None:
-                    ofg = fg
-                if obg is None and bg is not None:
-                    obg = bg
-
-            if oval is None:
-                oval = ' '
-
-            self._lines[y][x] = (oval, ofg, obg, z_index)
+            chars, cstyles, zs = self._chars[y], self._styles[y], self._z[y]
+            cells = range(x, x + width)
+            code = None
+            if val is not None:
+                code = _code(val)
+                for i in cells:
+                    # Cells of higher z-index only take characters if they are blank
+                    if z_index < zs[i] and chars[i] != _BLANK:
+                        code = None
+            for i in cells:
+                if code is not None:
+                    self._set_char(chars, i, code if i == x else _WIDE)
+                if z_index >= zs[i]:
+                    cstyles[i] = styles.merge(cstyles[i], style)
+                else:
+                    cstyles[i] = styles.merge(style, cstyles[i])
+                zs[i] = z_index
+            self._versions[y] = next(_stamps)
         except IndexError:
-            m = None
-            if y >= len(self._lines):
-                m = 'Attempt to set row outside of screen bounds'
-            elif x >= len(self._lines[y]):
-                m = 'Attempt to set column outside of screen bounds'
-            raise IndexError(m)
+            raise self._error(x + width - 1, y, 'set')
+
+    def _set_char(self, chars, x, code):
+        'Internal helper setting the code of a cell, blanking what is left of a wide character it overwrites'
+        if chars[x] == _WIDE and code != _WIDE and x > 0:
+            chars[x-1] = _BLANK
+        if x + 1 < self._width and chars[x+1] == _WIDE:
+            chars[x+1] = _BLANK
+        chars[x] = code
+
+    def copy(self):
+        '''Create a copy of the screen buffer
+
+        :returns: ScreenBuffer -- The new screen buffer'''
+        scr = ScreenBuffer(self._height, self._width)
+        scr.copy_from(self)
+        return scr
+
+    def copy_from(self, other):
+        '''Overwrite the content of this screen buffer in place with another of the same dimensions
+
+        :param ScreenBuffer other: The screen buffer to copy from'''
+        for dst, src in ((self._chars, other._chars), (self._styles, other._styles),
+                         (self._z, other._z)):
+            for y in range(self._height):
+                dst[y][:] = src[y]
+        self._versions[:] = other._versions
+        self._prev_style = other._prev_style
+
+    def reset(self):
+        '''Reset the whole screen buffer to blank cells in place'''
+        self.clear(0, 0, self._width, self._height)
+        self._versions[:] = [0] * self._height
+        self._prev_style = 0
+
+    def clear(self, x0, y0, x1, y1):
+        '''Reset a rectangle of the screen buffer to blank cells
+
+        :param int x0: The left column
+        :param int y0: The top row
+        :param int x1: The column after the right edge
+        :param int y1: The row after the bottom edge'''
+        n = x1 - x0
+        blank, none, below = array('I', [_BLANK]) * n, array('I', [0]) * n, array('i', [-1]) * n
+        for y in range(y0, y1):
+            chars = self._chars[y]
+            # Wide characters cut in half by the edges are blanked
+            if x0 > 0 and chars[x0] == _WIDE:
+                chars[x0-1] = _BLANK
+            if x1 < self._width and chars[x1] == _WIDE:
+                chars[x1] = _BLANK
+            chars[x0:x1] = blank
+            self._styles[y][x0:x1] = none
+            self._z[y][x0:x1] = below
+            self._versions[y] = next(_stamps)
+
+    def whole_cells(self, x0, y0, x1, y1):
+        '''Widen a rectangle until its left and right edges cut no wide character in half
+
+        :param int x0: The left column
+        :param int y0: The top row
+        :param int x1: The column after the right edge
+        :param int y1: The row after the bottom edge
+        :returns: tuple -- The widened rectangle, as (x0, y0, x1, y1)'''
+        rows = range(max(y0, 0), min(y1, self._height))
+        width = self._width
+        while True:
+            moved = False
+            for y in rows:
+                chars = self._chars[y]
+                if 0 < x0 < width and chars[x0] == _WIDE:
+                    x0 -= 1
+                    moved = True
+                if 0 < x1 < width and chars[x1] == _WIDE:
+                    x1 += 1
+                    moved = True
+            if not moved:
+                return x0, y0, x1, y1
 
     def get(self, x, y):
         '''Get a cell from the screen buffer
 
         :param int x: The x coordinate
         :param int y: The y coordinate
-        :returns: tuple -- The content of the cell'''
+        :returns: tuple -- The content of the cell, as (char, style, z_index). char is the empty string for the right half of a wide character.'''
         try:
-            return self._lines[y][x]
+            return (_char(self._chars[y][x]), self._styles[y][x], self._z[y][x])
         except IndexError:
-            m = None
-            if y >= len(self._lines):
-                m = 'Attempt to get row outside of screen bounds'
-            elif x >= len(self._lines[y]):
-                m = 'Attempt to get column outside of screen bounds'
-            raise IndexError(m)
+            raise self._error(x, y, 'get')
+
+    def _row_equal(self, old, y):
+        return (self._chars[y] == old._chars[y] and self._styles[y] == old._styles[y] and
+                self._z[y] == old._z[y])
 
     def _diff(self, old):
         '''Internal diff calculator between two ScreenBuffers.
 
+        Rows with the same version stamp are skipped without looking at their
+        cells. Rows found to be equal adopt the stamp of the old row, so the
+        next diff against this buffer can skip them as well.
+
         :param ScreenBuffer old: The old ScreenBuffer
-        :returns: list -- List of (x, y) tuples of all the changes'''
-        changed_coords = []
+        :returns: list -- List of (y, x0, x1) spans of changed cells, x1 being exclusive'''
+        spans = []
+        width = self._width
         for y in range(0, self._height):
-            for x in range(0, self._width):
-                oc, of, ob, oz = old._lines[y][x]
-                nc, nf, nb, nz = self._lines[y][x]
-                if (oc, of, ob, oz) != (nc, nf, nb, nz):
-                    changed_coords.append((x, y))
-        return changed_coords
+            if self._versions[y] == old._versions[y]:
+                continue
+            if self._row_equal(old, y):
+                self._versions[y] = old._versions[y]
+                continue
+            oc, ost, oz = old._chars[y], old._styles[y], old._z[y]
+            nc, nst, nz = self._chars[y], self._styles[y], self._z[y]
+            x = 0
+            while x < width:
+                if oc[x] != nc[x] or ost[x] != nst[x] or oz[x] != nz[x]:
+                    start = x
+                    x += 1
+                    while x < width and (oc[x] != nc[x] or ost[x] != nst[x] or oz[x] != nz[x]):
+                        x += 1
+                    # Wide characters are printed whole
+                    if start > 0 and nc[start] == _WIDE:
+                        start -= 1
+                    if x < width and nc[x] == _WIDE:
+                        x += 1
+                    spans.append((y, start, x))
+                else:
+                    x += 1
+        return spans
+
+    def _row_key(self, y):
+        return (self._chars[y].tobytes(), self._styles[y].tobytes())
+
+    def _find_scroll(self, old):
+        '''Internal detector of vertical shifts between two ScreenBuffers.
+
+        Changed rows vote for the offsets at which their content can be found
+        in the old buffer. The winning offset is used if shifting the changed
+        region by it makes at least two more rows match than leaving it.
+
+        :param ScreenBuffer old: The old ScreenBuffer
+        :returns: tuple -- (top, bottom, offset) of the region to shift, or None.
+            A positive offset moves content up, new row y being old row y+offset.'''
+        changed = [y for y in range(self._height)
+                   if self._versions[y] != old._versions[y] and not self._row_equal(old, y)]
+        if len(changed) < 3:
+            return None
+        top, bottom = changed[0], changed[-1] + 1
+
+        blank = ScreenBuffer(1, self._width)._row_key(0)
+        old_keys = [old._row_key(y) for y in range(top, bottom)]
+        new_keys = [self._row_key(y) for y in range(top, bottom)]
+        positions = {}
+        for y, key in enumerate(old_keys):
+            if key != blank:
+                positions.setdefault(key, []).append(y)
+
+        votes = {}
+        for y, key in enumerate(new_keys):
+            for oy in positions.get(key, ()):
+                if oy != y:
+                    votes[oy - y] = votes.get(oy - y, 0) + 1
+        if not votes:
+            return None
+        offset = max(votes, key=votes.get)
+
+        n = bottom - top
+        shifted = sum(1 for y in range(n) if 0 <= y + offset < n and new_keys[y] == old_keys[y + offset])
+        unshifted = sum(1 for y in range(n) if new_keys[y] == old_keys[y])
+        if shifted - unshifted < 2:
+            return None
+        return top, bottom, offset
+
+    def _shifted(self, top, bottom, offset):
+        '''Internal view of the buffer as the terminal shows it after a shift.
+        The rows are shared with this buffer, so the result must not be modified.
+
+        :param int top: The first row of the region
+        :param int bottom: The row after the region
+        :param int offset: The offset, as returned by _find_scroll
+        :returns: ScreenBuffer -- The shifted buffer'''
+        blank = ScreenBuffer(1, self._width)
+        scr = ScreenBuffer.__new__(ScreenBuffer)
+        scr._height, scr._width = self._height, self._width
+        scr._prev_style = self._prev_style
+        scr._chars, scr._styles, scr._z = self._chars[:], self._styles[:], self._z[:]
+        scr._versions = self._versions[:]
+        for y in range(top, bottom):
+            src, y0 = (self, y + offset) if top <= y + offset < bottom else (blank, 0)
+            scr._chars[y], scr._styles[y], scr._z[y] = src._chars[y0], src._styles[y0], src._z[y0]
+            scr._versions[y] = src._versions[y0]
+        return scr
+
+    def _compile_scroll(self, top, bottom, offset, res):
+        '''Internal handler for shifting a region of the terminal.
+        Lines are deleted or inserted at the top of the region, which is
+        limited with a scroll region if it does not reach the bottom.
+
+        :param int top: The first row of the region
+        :param int bottom: The row after the region
+        :param int offset: The offset, as returned by _find_scroll
+        :param list res: The result list'''
+        # Exposed lines are filled with the current background
+        if self._prev_style != 0:
+            res.append(styles.transition(self._prev_style, 0))
+            self._prev_style = 0
+        region = bottom < self._height
+        if region:
+            res.append('\x1b[%d;%dr' % (top+1, bottom))
+        res.append('\x1b[%d;1H' % (top+1))
+        if offset > 0:
+            res.append('\x1b[%dM' % offset)
+        else:
+            res.append('\x1b[%dL' % -offset)
+        if region:
+            res.append('\x1b[r')
 
     def _compile_char(self, x, y, res):
         '''Internal handler for rendering a character with a mode.
@@ -90,31 +331,199 @@ class ScreenBuffer(object):
         :param int x: The x coordinate
         :param int y: The y coordinate
         :param list res: The result list'''
-        c, f, b, z = self._lines[y][x]
-        # if f == '\x1b[36m':
-        #     import pdb;pdb.set_trace()
-        of, ob = self._prev_modes
-        if f != of:
-            if f is None: res.append('\x1b[39m')
-            else: res.append(f)
-        if b != ob:
-            if b is None: res.append('\x1b[49m')
-            else: res.append(b)
-        self._prev_modes = (f, b)
-        res.append(c)
+        self._compile_style(self._styles[y][x], res)
+        res.append(_char(self._chars[y][x]))
+
+    def _blank_tail(self, y):
+        '''Internal helper finding where the trailing run of identical blank cells of a row starts.
+
+        :param int y: The y coordinate
+        :returns: int -- The first column of the run, or the width if the row does not end blank'''
+        chars, cstyles = self._chars[y], self._styles[y]
+        x = self._width
+        if x == 0 or chars[x-1] != _BLANK or not styles.erasable(cstyles[x-1]):
+            return x
+        style = cstyles[x-1]
+        while x > 0 and chars[x-1] == _BLANK and cstyles[x-1] == style:
+            x -= 1
+        return x
+
+    def _compile_run(self, x0, x1, y, res):
+        '''Internal handler for rendering the cells between x0 and x1 of a row,
+        with the cursor at x0. Runs of identical cells are compressed with
+        erase and repeat sequences where that is shorter.
+
+        :param int x0: The first x coordinate
+        :param int x1: The x coordinate after the last cell
+        :param int y: The y coordinate
+        :param list res: The result list
+        :returns: tuple -- The resulting cursor column, and the column up to which the row is done'''
+        chars, cstyles = self._chars[y], self._styles[y]
+        use_rep = self.use_rep
+        tail = None
+        x = x0
+        while x < x1:
+            c, style = chars[x], cstyles[x]
+            if c != _BLANK and not use_rep:
+                # Print everything up to the next blank
+                end = x + 1
+                while end < x1 and chars[end] != _BLANK:
+                    end += 1
+                self._compile_cells(x, end, y, res)
+                x = end
+                continue
+            end = x + 1
+            while end < x1 and chars[end] == c and cstyles[end] == style:
+                end += 1
+            n = end - x
+            if c == _BLANK and styles.erasable(style):
+                if tail is None:
+                    tail = self._blank_tail(y)
+                if x >= tail and self._width - x > 3:
+                    # Erase in line
+                    self._compile_style(style, res)
+                    res.append('\x1b[K')
+                    return x, self._width
+                ech = '\x1b[%dX' % n
+                if end == x1 and len(ech) < n:
+                    # Erase characters, leaving the cursor in place
+                    self._compile_style(style, res)
+                    res.append(ech)
+                    return x, x1
+                cuf = '\x1b[%dC' % n
+                if len(ech) + len(cuf) < n:
+                    # Erase characters and move past them
+                    self._compile_style(style, res)
+                    res.append(ech)
+                    res.append(cuf)
+                    x = end
+                    continue
+            if use_rep and n > 1:
+                rep = '\x1b[%db' % (n - 1)
+                if len(rep) < n - 1:
+                    # Repeat the preceding character
+                    self._compile_char(x, y, res)
+                    res.append(rep)
+                    x = end
+                    continue
+            self._compile_cells(x, end, y, res)
+            x = end
+        return x1, x1
+
+    def _compile_cells(self, x0, x1, y, res):
+        '''Internal handler for printing the cells between x0 and x1 of a row as they are.
+
+        :param int x0: The first x coordinate
+        :param int x1: The x coordinate after the last cell
+        :param int y: The y coordinate
+        :param list res: The result list'''
+        cells, self._prev_style = self._cells(x0, x1, y, self._prev_style)
+        res.append(cells)
+
+    def _cells(self, x0, x1, y, prev):
+        '''Internal helper returning the cells between x0 and x1 of a row as printed from a style.
+
+        :param int x0: The first x coordinate
+        :param int x1: The x coordinate after the last cell
+        :param int y: The y coordinate
+        :param int prev: The current style ID
+        :returns: tuple -- The string, and the style ID afterwards'''
+        res = []
+        chars, cstyles = self._chars[y], self._styles[y]
+        for x in range(x0, x1):
+            style = cstyles[x]
+            if style != prev:
+                res.append(styles.transition(prev, style))
+                prev = style
+            res.append(_char(chars[x]))
+        return ''.join(res), prev
+
+    def _compile_move(self, cx, cy, x, y, res):
+        '''Internal handler for moving the cursor, choosing the cheapest way.
+
+        The candidates are an absolute move, relative moves, column moves,
+        carriage returns and line feeds, and reprinting the cells in between.
+        Each is costed in bytes, including the SGR sequence needed to get
+        from the style it leaves active to the style of the target cell.
+
+        :param int cx: The cursor column, the width if a wrap is pending, or None if unknown
+        :param int cy: The cursor row, or None if unknown
+        :param int x: The target x coordinate
+        :param int y: The target y coordinate
+        :param list res: The result list'''
+        prev = self._prev_style
+        first = self._styles[y][x]
+
+        if x == 0:
+            move = '\x1b[H' if y == 0 else '\x1b[%dH' % (y+1)
+        else:
+            move = '\x1b[%d;%dH' % (y+1, x+1)
+        best, best_style = move, prev
+        best_cost = len(move) + len(styles.transition(prev, first))
+
+        if cy is not None:
+            # After the last column, a wrap is pending, and terminals disagree
+            # on where relative moves go. Only moves setting the column are safe.
+            pending = cx >= self._width
+
+            # Vertical part, and the column it leaves the cursor in
+            dy = y - cy
+            verticals = [('\r', 0)] if dy == 0 else []
+            if dy == 0 and not pending:
+                verticals.append(('', cx))
+            elif dy > 0:
+                verticals.append(('\n' * dy, 0))
+                if not pending:
+                    verticals.append((min('\v' * dy, '\x1b[%dB' % dy, key=len), cx))
+            elif dy < 0:
+                up = '\x1b[A' if dy == -1 else '\x1b[%dA' % -dy
+                verticals.append(('\r' + up, 0))
+                if not pending:
+                    verticals.append((up, cx))
+
+            cost = lambda move, style: len(move) + len(styles.transition(style, first))
+            for vert, col in verticals:
+                candidates = [vert + ('\x1b[G' if x == 0 else '\x1b[%dG' % (x+1))]
+                if col == x:
+                    candidates.append(vert)
+                elif col < x:
+                    candidates.append(vert + ('\x1b[C' if x - col == 1 else '\x1b[%dC' % (x - col)))
+                else:
+                    candidates.append(vert + ('\x1b[D' if col - x == 1 else '\x1b[%dD' % (col - x)))
+                for move in candidates:
+                    c = cost(move, prev)
+                    if c < best_cost:
+                        best, best_style, best_cost = move, prev, c
+
+                # Reprinting costs at least a byte per cell, and cannot start
+                # on the right half of a wide character
+                if col < x and len(vert) + x - col < best_cost and self._chars[y][col] != _WIDE:
+                    cells, style = self._cells(col, x, y, prev)
+                    c = cost(vert + cells, style)
+                    if c < best_cost:
+                        best, best_style, best_cost = vert + cells, style, c
+
+        res.append(best)
+        self._prev_style = best_style
+
+    def _compile_style(self, style, res):
+        if style != self._prev_style:
+            res.append(styles.transition(self._prev_style, style))
+            self._prev_style = style
 
     def _compile_full(self):
         '''Compiles a regular render-string
         :returns: str - The rendered command string'''
-        res = ['\x1b[1;1H']
+        # The terminal may be left in any style by a previous frame
+        res = ['\x1b[1;1H\x1b[0m']
+        self._prev_style = 0
         for y in range(self._height):
-            for x in range(self._width):
-                self._compile_char(x, y, res)
+            self._compile_run(0, self._width, y, res)
             res.append('\n')
         res.pop()
         return ''.join(res)
 
-    def compile(self, old=None):
+    def compile(self, old=None, profiler=None):
         '''Compile render-string
 
         If an older screen instance is provided as argument, it will enable
@@ -122,44 +531,40 @@ class ScreenBuffer(object):
         bandwidth, as well as faster, flicker-free rendition.
 
         :param ScreenBuffer old: The old screen instance
+        :param Profiler profiler: Profiler to mark the scroll and diff phases and count changed cells in, or None
         :returns: str - The rendered command string'''
-        if old is None:
+        # Do not attempt optimized rendition after rescale
+        if old is None or self._height != old._height or self._width != old._width:
+            if profiler is not None:
+                profiler.count('cells', self._height * self._width)
             return self._compile_full()
 
-        # Do not attempt optimized rendition after rescale
-        if self._height != old._height or self._width != old._width:
-            return self.compile()
+        self._prev_style = old._prev_style
+        res = []
+
+        # Shift scrolled content in the terminal, and diff against the result
+        scroll = self._find_scroll(old)
+        if scroll is not None:
+            self._compile_scroll(scroll[0], scroll[1], scroll[2], res)
+            old = old._shifted(*scroll)
 
         # Compile diff
-        changed_coords = self._diff(old)
-        self._prev_modes = old._prev_modes
+        if profiler is not None:
+            profiler.mark('scroll')
+        spans = self._diff(old)
+        if profiler is not None:
+            profiler.mark('diff')
+            profiler.count('cells', sum(x1 - x0 for y, x0, x1 in spans))
 
-        # We need to keep a track
-        res = []
-        origin_move = False
-        prev_x, prev_y = -10, -10
-        for x,y in changed_coords:
-            if origin_move and y == prev_y and x == prev_x + 1:
-                # Single-character move
-                # Cursor moves forward by itself, so no work necessary
-                self._compile_char(x, y, res)
-            elif origin_move and y == prev_y and x < prev_x + (6 + (x > 9) + (y > 9)):
-                # Multi-character move
-                # Short enough that it's faster to just render
-                # everything up to this character to move the cursor
-                for i in range(prev_x+1, x+1):
-                    self._compile_char(i, y, res)
-            else:
-                # Long multi-character move, or first move
-                # Use a cursor move
-                if x == 0 and y == prev_y + 1:
-                    res.append('\n')
-                elif x == prev_x + 1 and y == prev_y + 1:
-                    res.append('\v')
-                else:
-                    res.append('\x1b[%d;%dH' % (y+1, x+1))
-                self._compile_char(x, y, res)
-                origin_move = True
-            prev_x, prev_y = x, y
+        # Track the cursor, and how far its row is already done
+        cx, cy, done = None, None, 0
+        for y, x0, x1 in spans:
+            if y == cy and x1 <= done:
+                # Already erased
+                continue
+            if y != cy or x0 != cx:
+                self._compile_move(cx, cy, x0, y, res)
+            cx, done = self._compile_run(x0, x1, y, res)
+            cy = y
 
         return ''.join(res)
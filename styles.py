@@ -0,0 +1,122 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from terminal import Terminal
+
+class StyleTable(object):
+    '''Style interning table
+
+    Maps style attribute tuples of (fg, bg, bold, underline) to small integer
+    IDs. fg and bg are (color, bright) tuples, bold and underline are booleans.
+    Any attribute may be None, meaning that it is not set, which renders as the
+    terminal default. ID 0 is the style with no attributes set.
+
+    The combined SGR sequence of every ID, as well as the minimal sequence
+    needed to go from one ID to another, are computed once and cached.'''
+    def __init__(self):
+        self._styles = [(None, None, None, None)]
+        self._ids = {self._styles[0]: 0}
+        self._sgr = {}
+        self._transitions = {}
+        self._merges = {}
+
+    def __len__(self):
+        return len(self._styles)
+
+    def intern(self, fg=None, bg=None, bold=None, underline=None):
+        '''Get the ID of a style
+
+        :param tuple fg: The foreground (color, bright) tuple
+        :param tuple bg: The background (color, bright) tuple
+        :param bool bold: Whether the text is bold
+        :param bool underline: Whether the text is underlined
+        :returns: int -- The style ID'''
+        key = (fg, bg, bold, underline)
+        try:
+            return self._ids[key]
+        except KeyError:
+            self._ids[key] = len(self._styles)
+            self._styles.append(key)
+            return self._ids[key]
+
+    def get(self, style):
+        '''Get the attributes of a style
+
+        :param int style: The style ID
+        :returns: tuple -- The (fg, bg, bold, underline) tuple'''
+        return self._styles[style]
+
+    def erasable(self, style):
+        '''Check whether erasing cells with a style active yields blank cells of that style.
+        Erased cells only take the background, so this does not hold for underlined styles.
+
+        :param int style: The style ID
+        :returns: bool -- Whether erase sequences can be used for blanks of the style'''
+        return not self._styles[style][3]
+
+    def merge(self, under, over):
+        '''Combine two styles, the attributes set in over taking precedence
+
+        :param int under: The style ID providing defaults
+        :param int over: The style ID overriding them
+        :returns: int -- The combined style ID'''
+        if over == 0 or under == over:
+            return under
+        if under == 0:
+            return over
+        try:
+            return self._merges[(under, over)]
+        except KeyError:
+            attrs = [o if o is not None else u for u, o in zip(self._styles[under], self._styles[over])]
+            res = self._merges[(under, over)] = self.intern(*attrs)
+            return res
+
+    @staticmethod
+    def _params(attrs, prev=None):
+        fg, bg, bold, underline = attrs
+        pfg, pbg, pbold, punderline = prev or (None, None, None, None)
+        res = []
+        if bool(bold) != bool(pbold):
+            res.append(1 if bold else 22)
+        if bool(underline) != bool(punderline):
+            res.append(4 if underline else 24)
+        if fg != pfg:
+            res.append(39 if fg is None else (90 if fg[1] else 30) + Terminal.colors[fg[0]])
+        if bg != pbg:
+            res.append(49 if bg is None else (100 if bg[1] else 40) + Terminal.colors[bg[0]])
+        return res
+
+    @staticmethod
+    def _csi(params):
+        return '\x1b[%sm' % ';'.join(str(p) for p in params)
+
+    def sgr(self, style):
+        '''Get the SGR sequence selecting a style from any state
+
+        :param int style: The style ID
+        :returns: str -- The escape sequence'''
+        try:
+            return self._sgr[style]
+        except KeyError:
+            res = self._sgr[style] = self._csi([0] + self._params(self._styles[style]))
+            return res
+
+    def transition(self, old, new):
+        '''Get the shortest SGR sequence going from one style to another
+
+        :param int old: The current style ID
+        :param int new: The wanted style ID
+        :returns: str -- The escape sequence, empty if the styles are equal'''
+        if old == new:
+            return ''
+        try:
+            return self._transitions[(old, new)]
+        except KeyError:
+            params = self._params(self._styles[new], self._styles[old])
+            res = self._csi(params) if params else ''
+            full = self.sgr(new)
+            if len(full) < len(res):
+                res = full
+            self._transitions[(old, new)] = res
+            return res
+
+# The table shared by all screen buffers, so style IDs compare across them
+styles = StyleTable()
@@ -1,23 +1,67 @@
 from __future__ import print_function
-import select, signal, sys, termios, fcntl, signal, os
+import select, signal, sys, termios, fcntl, signal, os, time, errno, re, heapq
+from itertools import count
 from pyte import ByteStream
 from terminal import Terminal
 from document import *
 from screenbuffer import *
+from styles import styles
+from cellwidth import Wrap, clusters, is_simple
 from collections import deque
+from bisect import bisect_left
+from profiler import Profiler
+
+clock = getattr(time, 'monotonic', time.time)
 
 class ByteStream(ByteStream):
+    '''Input parser. Consecutive characters are dispatched as a single draw event.'''
     def __init__(self, cb):
         super(ByteStream, self).__init__()
         self.cb = cb
+        self.drawn = []
         self.csi['~'] = 'function_key'
         self.basic['\x7f'] = 'delete'
 
+    def feed(self, data):
+        super(ByteStream, self).feed(data)
+        self.flush()
+
+    def flush(self):
+        if self.drawn:
+            text, self.drawn = ''.join(self.drawn), []
+            self.cb(Event('draw', (text,), {}))
+
     def dispatch(self, event, *args, **kwargs):
-        self.cb(Event(event, args, kwargs))
+        if event == 'draw':
+            self.drawn.append(args[0])
+        else:
+            self.flush()
+            self.cb(Event(event, args, kwargs))
         if kwargs.get('reset', True):
             self.reset()
 
+PASTE_START = b'\x1b[200~'
+PASTE_END = b'\x1b[201~'
+
+def _partial_suffix(data, marker):
+    'Returns the length of the longest end of data that starts marker'
+    for n in range(min(len(marker) - 1, len(data)), 0, -1):
+        if marker.startswith(data[-n:]):
+            return n
+    return 0
+
+
+def _union(a, b):
+    if a is None: return b
+    if b is None: return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def _contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and a[2] >= b[2] and a[3] >= b[3]
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
 
 class Renderer(object):
     """
@@ -28,6 +72,8 @@ It currently traverses the elements, generating a stream of commands on the way.
 Instead, I have considered having an array per line. Each array represents a character position, and can be set to contain a character + graphics commands.
 After rendering to this space, one can identify dirty lines, and generate the command stream from there.
 
+Differential renders only repaint the damaged part of the screen, and blocks cache their box and the flow of their children, so content that is unchanged or scrolled out of view is skipped.
+
 The renderer is still not feature complete, though, which should be of higher priority (It needs to be able to handle blocks in all positions)
 """
     def __init__(self, o):
@@ -35,60 +81,354 @@ The renderer is still not feature complete, though, which should be of higher pr
         self.box_stack = []
         self.cur_pos = []
         self.styles = []
+        self.bounds = []
         self.screen = None
         self.old_scr = None
+        self.spare_scr = None
+        self.old_body = None
+        self.tabstop = 4
+        self.damage = None
+        self.clip = None
+        self.restart = False
+        self.profiler = None
+
+    def render(self, height, width, tabstop=4, differential=True, base=None):
+        '''Renders the document, returning the output to bring the terminal up to date.
+        Differential output is compiled against the previous frame, or against base if given.
 
-    def render(self, height, width, tabstop=4, differential=True):
+        Differential renders only repaint the damage: the old rectangles of every node that changed.
+        The previous screen is copied, the damage is cleared, and the tree is walked again with writes
+        clipped to it. If a block turns out to have moved, or a wide character is cut by the edge of the
+        damage, the damage grows and the pass is repeated, so nothing outside of it changes.
+
+        If a Profiler is set as profiler, the phases of the render are marked on it and the cells that
+        changed are counted. The frame itself is begun and ended by the caller.'''
         obj = self.obj.body
+        self.tabstop = tabstop
+        old = self.old_scr
+        profiler = self.profiler
+
+        if (not differential or old is None or obj is not self.old_body or
+                old._height != height or old._width != width):
+            self.damage = None
+            screen = self._buffer(height, width, base)
+            screen.reset()
+            self._paint(obj, screen, height, width)
+        else:
+            self.damage = []
+            self._collect(obj, None)
+            if profiler is not None:
+                profiler.mark('collect')
+            screen = self._buffer(height, width, base)
+            while True:
+                # Wide characters are repainted whole, as painting one half would change the other
+                self.damage = [old.whole_cells(*rect) for rect in self.damage]
+                screen.copy_from(old)
+                for x0, y0, x1, y1 in self._clipped_damage(height, width):
+                    screen.clear(x0, y0, x1, y1)
+                self._paint(obj, screen, height, width)
+                if not self.restart:
+                    break
+
+        if profiler is not None:
+            profiler.mark('paint')
+        if obj._dirty or obj._child_dirty:
+            self._clean(obj)
+        self.damage = None
+        self.clip = None
+        if profiler is not None:
+            profiler.mark('clean')
+        if base is None:
+            base = old
+        res = self.screen.compile(base if differential else None, profiler)
+        if profiler is not None:
+            profiler.mark('compile')
+        self.old_scr, self.spare_scr = self.screen, old
+        self.old_body = obj
+        return res
+
+    def _buffer(self, height, width, keep=None):
+        'Returns the spare ScreenBuffer for reuse if it fits and is not kept, otherwise a new one'
+        scr = self.spare_scr
+        self.spare_scr = None
+        if scr is None or scr is keep or scr._height != height or scr._width != width:
+            scr = ScreenBuffer(height, width)
+        return scr
+
+    def _paint(self, obj, screen, height, width):
         self.box_stack = [(height, width, 0, 0)]
         self.cur_pos = [(0,0)]
-        self.styles = [(None, None)]
-        self.screen = ScreenBuffer(height, width)
-
+        self.styles = [0]
+        self.bounds = [None]
+        self.screen = screen
+        self.restart = False
+        self.clip = None
+        if self.damage is not None:
+            self.clip = [None] * height
+            for x0, y0, x1, y1 in self._clipped_damage(height, width):
+                for y in range(y0, y1):
+                    row = self.clip[y]
+                    if row is None:
+                        row = self.clip[y] = bytearray(width)
+                    row[x0:x1] = b'\x01' * (x1 - x0)
         self.selector(obj)
-        res = self.screen.compile(self.old_scr if differential else None)
-        self.old_scr = self.screen
-        return res
+
+    def _clipped_damage(self, height, width):
+        for x0, y0, x1, y1 in self.damage:
+            x0, y0 = max(x0, 0), max(y0, 0)
+            x1, y1 = min(x1, width), min(y1, height)
+            if x0 < x1 and y0 < y1:
+                yield x0, y0, x1, y1
+
+    def _damaged(self, rect):
+        if rect is None:
+            return False
+        for d in self.damage:
+            if _intersects(rect, d):
+                return True
+        return False
+
+    def _add_damage(self, rect):
+        'Adds a rectangle to the damage. If it was not already covered, the current pass is invalid.'
+        if rect is None:
+            return
+        for d in self.damage:
+            if _contains(d, rect):
+                return
+        self.damage.append(rect)
+        self.restart = True
+
+    def _visible(self, x, y):
+        clip = self.clip
+        if clip is None:
+            return True
+        if y < 0 or y >= len(clip) or clip[y] is None:
+            return False
+        row = clip[y]
+        return 0 <= x < len(row) and row[x] != 0
+
+    def _collect(self, obj, block):
+        'Collects the previously painted rectangles of all dirty nodes'
+        if obj._dirty:
+            if obj.type in ('block', 'styleoverride'):
+                rect = obj._bounds if obj.type == 'block' else obj._rect
+                if rect is not None:
+                    self.damage.append(rect)
+            elif block is None:
+                self.damage.append((0, 0, self.old_scr._width, self.old_scr._height))
+            elif block._bounds is not None:
+                # Text without room in its box runs past it, into the bounds
+                self.damage.append(block._bounds)
+            return
+        if obj._child_dirty:
+            children = obj.children
+            if obj.type == 'block':
+                block, children = obj, obj._changed
+            for child in children:
+                if child._dirty or child._child_dirty:
+                    self._collect(child, block)
+
+    def _clean(self, obj):
+        obj._dirty = obj._child_dirty = False
+        if obj.type == 'block':
+            children, obj._changed = obj._changed, set()
+        else:
+            children = obj.children
+        for child in children:
+            if child._dirty or child._child_dirty:
+                self._clean(child)
 
     def _block(self, obj):
+        '''Lays out and paints a block.
+        The box is cached along with the box of the parent, the cursor position and the LayoutStyle it was
+        computed from, so blocks laid out the same reuse it. Blocks that are clean, keep their box and are
+        outside of the damage are not painted again, as their cells from the previous frame are valid.'''
         box_stack = self.box_stack
         cur_pos = self.cur_pos
 
-        height, width, x_off, y_off = box_stack[-1]
-        cx, cy = cur_pos[-1]
-
-        height = height if obj.height is None else obj.height
-        width = width if obj.width is None else obj.width
-        if obj.absolute:
-            x_off = obj.pos_x
-            y_off = obj.pos_y
+        # The box only depends on the box of the parent, the cursor position
+        # and the style of the block, which is replaced rather than changed
+        key = (box_stack[-1], cur_pos[-1], obj._layout)
+        if key == obj._layout_key:
+            box, rect = obj._box, obj._rect
         else:
-            x_off += cx
-            y_off += cy
+            height, width, x_off, y_off = box_stack[-1]
+            cx, cy = cur_pos[-1]
+            layout = obj._layout
+
+            height = height if layout.height is None else layout.height
+            width = width if layout.width is None else layout.width
+            if layout.absolute:
+                x_off = layout.pos_x
+                y_off = layout.pos_y
+            else:
+                x_off += cx
+                y_off += cy
+
+            x_off += layout.margin_left
+            y_off += layout.margin_top
+            height -= layout.margin_bottom + layout.margin_top
+            width -= layout.margin_left + layout.margin_right
 
-        x_off += obj.margin_left
-        y_off += obj.margin_top
-        height -= obj.margin_bottom + obj.margin_top
-        width -= obj.margin_left + obj.margin_right
+            box = (height, width, x_off, y_off)
+            rect = (x_off, y_off, x_off + max(width, 0), y_off + max(height, 0))
+
+        if self.damage is not None:
+            if box != obj._box:
+                self._add_damage(obj._bounds)
+                self._add_damage(rect)
+            elif not (obj._dirty or obj._child_dirty or self._damaged(obj._bounds)):
+                # Untouched, so the cells from the previous frame are valid
+                obj._layout_key = key
+                self.bounds[-1] = _union(self.bounds[-1], obj._bounds)
+                return
 
         cur_pos.append((0,0))
-        box_stack.append((height, width, x_off, y_off))
+        box_stack.append(box)
+        self.bounds.append(rect)
 
-        obj.enter(self.selector)
+        self._enter_block(obj, box[0], box[1])
 
         box_stack.pop()
         cur_pos.pop()
+        bounds = self.bounds.pop()
+
+        if self.damage is not None and bounds != obj._bounds:
+            self._add_damage(bounds)
+        obj._box, obj._rect, obj._bounds, obj._layout_key = box, rect, bounds, key
+        self.bounds[-1] = _union(self.bounds[-1], bounds)
+
+    def _overflow(self, x0, y, x1):
+        'Adds a row of cells painted outside of the box to the bounds of the block'
+        self.bounds[-1] = _union(self.bounds[-1], (x0, y, x1, y + 1))
+
+    def _rows(self):
+        'Returns the range of rows of the current box that are on the screen'
+        height, width, x_off, y_off = self.box_stack[-1]
+        return max(-y_off, 0), min(height, self.screen._height - y_off)
+
+    def _enter_block(self, obj, height, width):
+        """Paints the children of a block, skipping those that are scrolled out of the box.
+        The first visible child is found by bisection in the flow cache of the block.
+        Children that paint anything but text flowing from the cursor are always painted, as they may show up anywhere."""
+        self._update_flow(obj, width)
+        children = obj.children
+        rows, cols, fixed = obj._flow_rows, obj._flow_cols, obj._flow_fixed
+        scroll = obj._scroll
+
+        # Child i spans from the row rows[i-1] to rows[i]
+        top, bottom = self._rows()
+        first = bisect_left(rows, scroll + top)
+        end = min(bisect_left(rows, scroll + bottom) + 1, len(children))
+        visible = list(range(first, end))
+        if fixed:
+            visible = fixed[:bisect_left(fixed, first)] + visible + fixed[bisect_left(fixed, end):]
+
+        cur_pos = self.cur_pos
+        for i in visible:
+            cur_pos[-1] = (cols[i-1], rows[i-1] - scroll) if i else (0, -scroll)
+            self.selector(children[i])
+
+    def _update_flow(self, obj, width):
+        'Brings the flow cache of a block up to date, measuring the children that changed and everything after them'
+        children = obj.children
+        key = (width, self.tabstop)
+        if key != obj._flow_key:
+            obj._flow_rows, obj._flow_cols, obj._flow_fixed, obj._flow_index = [], [], [], {}
+            obj._flow_valid = 0
+        valid = obj._flow_valid
+        index = obj._flow_index
+        if valid:
+            for node in obj._changed:
+                i = index.get(id(node))
+                if i is not None and i < valid:
+                    valid = i
+        rows, cols, fixed = obj._flow_rows, obj._flow_cols, obj._flow_fixed
+        if valid == len(children) == len(rows):
+            return
+
+        if valid == 0:
+            index.clear()
+        del rows[valid:], cols[valid:], fixed[bisect_left(fixed, valid):]
+        cx, cy = (cols[-1], rows[-1]) if valid else (0, 0)
+        for i in range(valid, len(children)):
+            child = children[i]
+            cx, cy, flow = self._measure(child, cx, cy, width)
+            rows.append(cy)
+            cols.append(cx)
+            if not flow:
+                fixed.append(i)
+            index[id(child)] = i
+        obj._flow_key, obj._flow_valid = key, len(children)
+
+    def _measure(self, obj, cx, cy, width):
+        """Returns the cursor position after a node without painting it, and whether the node only paints text flowing from the cursor.
+        Text that is scrolled out of view only needs to be measured."""
+        t = obj.type
+        if t == 'text':
+            if not is_simple(obj.content):
+                ex, ey = self._wrap(obj, cx, width).end
+                return ex, cy + ey, True
+            n = len(obj.content)
+            if width <= 0 or cx >= width:
+                return cx + n, cy, True
+            return (cx + n) % width, cy + (cx + n) // width, True
+        if t == 'newline':
+            return 0, cy + 1, True
+        if t == 'tab':
+            diff = self.tabstop - (cx % self.tabstop)
+            if cx + diff > width:
+                return diff, cy + 1, True
+            return cx + diff, cy, True
+        if t in ('block', 'styleoverride'):
+            return cx, cy, False
+        if t == 'textbuffer':
+            lines = obj.rope.line_count() - obj.top_line
+            return (0, cy + lines, False) if lines > 0 else (cx, cy, False)
+        flow = True
+        for child in obj.children:
+            cx, cy, f = self._measure(child, cx, cy, width)
+            flow = flow and f
+        return cx, cy, flow
+
+    def _wrap(self, obj, cx, width):
+        'Returns the text of a node broken into rows, from its wrap cache if that was laid out the same'
+        wrap = obj._wrap
+        if wrap is None or wrap.key != (cx, width, self.tabstop):
+            wrap = obj._wrap = Wrap(obj.content, cx, width, self.tabstop)
+        return wrap
 
     def _text(self, obj):
+        content = obj.content
+        if not is_simple(content):
+            return self._wrapped_text(obj)
+
         height, width, x_off, y_off = self.box_stack[-1]
         cx, cy = self.cur_pos[-1]
-        fstyle, bstyle = self.styles[-1]
+        style = self.styles[-1]
+        clip = self.clip
 
-        for c in obj.content:
-            if cy >= height:
+        top, bottom = self._rows()
+        if 0 <= cx < width:
+            # Only the part of the text inside the box and on the screen is walked
+            start = 0
+            if cy < top:
+                end = self._measure(obj, cx, cy, width)
+                if end[1] < top:
+                    self.cur_pos[-1] = end[:2]
+                    return
+                start = width - cx + (top - cy - 1) * width
+                cx, cy = 0, top
+            content = content[start:start + max(bottom - cy, 0) * width - cx]
+        elif top <= cy < bottom and content:
+            # Without room in the box, the text runs past it on a single row
+            self._overflow(x_off + cx, y_off + cy, x_off + cx + len(content))
+
+        for c in content:
+            if cy >= bottom:
                 break
-            if cy >= 0:
-                self.screen.set(x_off+cx, y_off+cy, c, fstyle, bstyle)
+            if cy >= top and (clip is None or self._visible(x_off+cx, y_off+cy)):
+                self.screen.set(x_off+cx, y_off+cy, c, style)
             if cx == width-1:
                 cx = 0
                 cy += 1
@@ -96,6 +436,58 @@ The renderer is still not feature complete, though, which should be of higher pr
                 cx += 1
         self.cur_pos[-1] = (cx, cy)
 
+    def _wrapped_text(self, obj):
+        'Paints text that is not all one cell per character, from its wrap cache'
+        height, width, x_off, y_off = self.box_stack[-1]
+        cx, cy = self.cur_pos[-1]
+        style = self.styles[-1]
+
+        wrap = self._wrap(obj, cx, width)
+        cells, breaks = wrap.cells, wrap.breaks
+        top, bottom = self._rows()
+        if not 0 <= cx < width and top <= cy < bottom and cells:
+            # Without room in the box, the text runs past it on a single row
+            self._overflow(x_off + cells[0][1], y_off + cy, x_off + cells[-1][1] + cells[-1][2])
+        for row in range(max(top - cy, 0), min(bottom - cy, len(breaks) - 1)):
+            y = y_off + cy + row
+            for i in range(breaks[row], breaks[row+1]):
+                c, x, w = cells[i]
+                self._cell(x_off + x, y, c, w, style)
+        self.cur_pos[-1] = (wrap.end[0], cy + wrap.end[1])
+
+    def _cell(self, x, y, c, w, style):
+        '''Paints a character w cells wide where the clip allows.
+        A wide character is only ever painted whole, and if the edge of the damage cuts it, the damage grows to take it.'''
+        if self.clip is None or self._visible(x, y) and (w == 1 or self._visible(x+1, y)):
+            self.screen.set(x, y, c, style, width=w)
+        elif w == 2 and (self._visible(x, y) or self._visible(x+1, y)):
+            self._add_damage((x, y, x+2, y+1))
+
+    def _textbuffer(self, obj):
+        height, width, x_off, y_off = self.box_stack[-1]
+        cx, cy = self.cur_pos[-1]
+        style = self.styles[-1]
+        rope = obj.rope
+        tabstop = self.tabstop
+
+        top, bottom = self._rows()
+        line, count = obj.top_line, rope.line_count()
+        if cy < top:
+            line, cy, cx = line + top - cy, top, 0
+        while cy < bottom and line < count:
+            text = rope.line(line)
+            for c, w in ([(c, 1) for c in text] if is_simple(text) else clusters(text)):
+                if c == '\t':
+                    cx += tabstop - (cx % tabstop)
+                    continue
+                if cx + w > width:
+                    break
+                self._cell(x_off+cx, y_off+cy, c, w, style)
+                cx += w
+            line += 1
+            cx, cy = 0, cy + 1
+        self.cur_pos[-1] = (cx, cy)
+
     def _newline(self, obj):
         cx, cy = self.cur_pos[-1]
         self.cur_pos[-1] = (0, cy + 1)
@@ -111,13 +503,14 @@ The renderer is still not feature complete, though, which should be of higher pr
             cx += diff
         self.cur_pos[-1] = (cx, cy)
 
+    def _style_id(self, obj):
+        return styles.intern(
+            (obj.color, obj.bright) if obj.color else None,
+            (obj.bg_color, obj.bg_bright) if obj.bg_color else None,
+            obj.bold, obj.underline)
+
     def _style(self, obj):
-        f, b = None, None
-        if obj.color:
-            f = Terminal.fcolor(obj.color, obj.bright)
-        if obj.bg_color:
-            b = Terminal.bcolor(obj.bg_color, obj.bg_bright)
-        self.styles.append((f, b))
+        self.styles.append(self._style_id(obj))
         obj.enter(self.selector)
         self.styles.pop()
 
@@ -128,51 +521,151 @@ The renderer is still not feature complete, though, which should be of higher pr
             y_off = obj.pos_y
         x, y = x_off + obj.margin_left, y_off + obj.margin_top
 
-        val, fg, bg, z_index = self.screen.get(x, y)
-        if obj.color:
-            fg = Terminal.fcolor(obj.color, obj.bright)
-        if obj.bg_color:
-            bg = Terminal.bcolor(obj.bg_color, obj.bg_bright)
+        rect = (x, y, x+1, y+1)
+        self.bounds[-1] = _union(self.bounds[-1], rect)
+        if self.damage is not None:
+            if rect != obj._rect:
+                self._add_damage(obj._rect)
+                self._add_damage(rect)
+        obj._rect = rect
+        screen = self.screen
+        if not (0 <= x < screen._width and 0 <= y < screen._height and self._visible(x, y)):
+            return
 
-        self.screen.set(x, y, fg=fg, bg=bg, z_index=z_index+10)
+        val, style, z_index = screen.get(x, y)
+        screen.set(x, y, style=self._style_id(obj), z_index=z_index+10)
 
     def selector(self, obj):
-        try:
-            getattr(self, '_'+obj.type)(obj)
-        except KeyError:
+        f = getattr(self, '_'+obj.type, None)
+        if f is None:
             return obj.enter(self.selector)
+        f(obj)
+
+class Timer(object):
+    'A timer set up with System.call_later or System.call_every'
+    def __init__(self, deadline, interval, fn, args, kwargs):
+        self.deadline = deadline
+        self.interval = interval
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def reschedule(self, now):
+        'Moves the deadline of a repeating timer to its next tick after now, skipping missed ticks'
+        missed = int((now - self.deadline) // self.interval) + 1
+        self.deadline += max(missed, 1) * self.interval
+
+    def fire(self):
+        self.fn(*self.args, **self.kwargs)
+
 
 class System(object):
     """
 The system class.
 
 This class manages the entire application, from calling the renderer to dispatching of events.
+
+Document updates are coalesced into frames, which are paced to max_fps and, in adaptive mode, to the link to the terminal, and written without blocking. The document must only be mutated from the thread running the event loop, and other threads post transactions to it.
 """
-    def __init__(self):
+    # DECRQM report for synchronized updates: 1 and 2 mean set and reset,
+    # 3 permanently set. 0 (unknown) and 4 (permanently reset) mean no.
+    sync_report = re.compile(b'\x1b\\[\\?2026;([0-4])\\$y')
+    # Primary device attributes and device status, answering the probes of
+    # adaptive mode, which switch between the two after a probe is lost
+    device_report = re.compile(b'\x1b\\[\\?[0-9;]*c')
+    status_report = re.compile(b'\x1b\\[0n')
+    # The start of a report, held back until the rest of it has been read
+    partial_report = re.compile(b'\x1b\\[(\\?[0-9;$]*|0)\\Z')
+    # Seconds after which input that may start a paste marker is taken as keys
+    escape_timeout = 0.05
+    # Seconds after which a probe is taken to be unanswered
+    probe_timeout = 10
+    # Weight of the earlier drain measurements against the next one
+    link_decay = 0.75
+    # Frames per second animations are capped to if max_fps is not given
+    animation_fps = 60
+
+    def __init__(self, max_fps=None, sync=None, adaptive=False):
+        '''max_fps caps the frames rendered per second, even while input keeps arriving.
+        sync enables synchronized updates (DEC mode 2026), so frames are presented atomically. By default
+        support is probed with DECRQM at startup, and the mode is only used if the terminal reports it.
+        adaptive paces frames to what the link to the terminal sustains, see pace.
+        Setting NEWUI_PROFILE to a path profiles from startup, logging every frame there.'''
         self.document = Document()
         self.renderer = Renderer(self.document)
         self.document.updatehook = self.updatehook
         self.oldattrs = None
-        self._scroll = 0
         self.bytestream = ByteStream(self.document.event)
+        self.read_size = 1024
+        self.input_tail = b''
+        self.input_time = 0
+        self.paste = None
+
+        self.dirty = False
+        self.last_frame = 0
+        self.frame_interval = 1.0 / max_fps if max_fps else None
+
+        self.timers = []
+        self.timer_seq = count()
+        self.animation_callbacks = []
+
+        self.outfd = sys.stdout.fileno()
+        self.output = deque([])
+        self.written = 0
+        self.flushed_scr = None
+        self.sync = bool(sync)
+
+        self.adaptive = adaptive
+        self.probe = None
+        self.probe_kind = 0
+        self.unprobed = 0
+        self.latency = None
+        self.link_bytes = 0
+        self.link_busy = 0
+        self.link_free = 0
+
+        self.profiler = None
+        if os.environ.get('NEWUI_PROFILE'):
+            self.profile(open(os.environ['NEWUI_PROFILE'], 'a'))
 
         self.document.setdimensions(*self.getdimensions())
         self.setup()
         self.setup_signal()
         self.enable_alternate()
+        if sync is None:
+            self.write('\x1b[?2026$p')
+        if adaptive:
+            self.send_probe()
 
         self.pending = deque([])
+        self.setup_waker()
 
+    def setup_waker(self):
+        'Opens the self-pipe waking the event loop for signals and posted transactions'
         waker, wakew = os.pipe()
         self.waker, self.wakew = os.fdopen(waker,'rb',0), os.fdopen(wakew,'wb',0)
 
 
-        fl = fcntl.fcntl(waker, fcntl.F_GETFL)
-        fcntl.fcntl(waker, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        for fd in (waker, wakew):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
     def queue(self, cmd):
         self.pending.append(cmd)
-        self.wakew.write(b"\x00")
+        try:
+            self.wakew.write(b"\x00")
+        except IOError:
+            # The pipe is full, so the loop is due to wake up anyway
+            pass
+
+    def post(self, fn, *args, **kwargs):
+        '''Queues a document transaction from any thread. fn is called with the arguments on the event loop,
+        and followed by a single frame.'''
+        self.queue(lambda: fn(*args, **kwargs))
 
     def handle_queue(self):
         while len(self.pending):
@@ -181,21 +674,287 @@ This class manages the entire application, from calling the renderer to dispatch
                 self.restore()
             elif o == 'rescale':
                 self.rescale()
+            elif callable(o):
+                o()
 
     def updatehook(self, obj):
-        self.render(obj)
+        if self.profiler is not None:
+            self.profiler.notify(obj)
+        self.schedule_render(obj)
+
+    def profile(self, log=None, window=120):
+        '''Starts profiling frames, optionally writing them to the file log as JSON lines. Returns the Profiler.
+        Every frame records the time spent on each phase of rendering and on writing, the node whose
+        notification triggered it, the notifications it coalesced, and the cells and bytes it changed.
+        When profiling is off, a notification costs a single check.'''
+        self.profiler = self.renderer.profiler = Profiler(log, window)
+        return self.profiler
+
+    def stop_profile(self):
+        'Stops profiling frames, returning the Profiler'
+        profiler, self.profiler = self.profiler, None
+        self.renderer.profiler = None
+        return profiler
+
+    def stats(self):
+        'Returns a summary of the last frames profiled, see Profiler.stats'
+        if self.profiler is None:
+            return None
+        return self.profiler.stats()
+
+    def schedule_render(self, obj=None):
+        'Marks the system dirty. A single frame is rendered once the event loop has drained its pending input.'
+        self.dirty = True
+
+    def frame_timeout(self):
+        'Returns the time until the next frame may be rendered, or None if no frame is pending'
+        if not self.dirty:
+            return None
+        due = self.link_free
+        interval = self.frame_interval
+        if interval is None and self.animation_callbacks:
+            interval = 1.0 / self.animation_fps
+        if interval is not None:
+            due = max(due, self.last_frame + interval)
+        return max(0, due - clock())
+
+    def call_later(self, delay, fn, *args, **kwargs):
+        'Calls fn with the arguments after delay seconds. Returns a Timer that can be cancelled.'
+        return self.add_timer(Timer(clock() + delay, None, fn, args, kwargs))
 
-    def render(self, obj=None, _retry=0, differential=True):
+    def call_every(self, interval, fn, *args, **kwargs):
+        'Calls fn with the arguments every interval seconds, starting after one interval. Returns a Timer that can be cancelled.'
+        return self.add_timer(Timer(clock() + interval, interval, fn, args, kwargs))
+
+    def add_timer(self, timer):
+        heapq.heappush(self.timers, (timer.deadline, next(self.timer_seq), timer))
+        return timer
+
+    def timer_timeout(self):
+        'Returns the time until the next timer is due, or None if there are none'
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - clock())
+
+    def run_timers(self):
+        'Fires the timers that are due. Any number of them firing together cause a single frame.'
+        now = clock()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, n, timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            if timer.interval is not None:
+                timer.reschedule(now)
+                self.add_timer(timer)
+            timer.fire()
+
+    def request_animation_frame(self, fn):
+        '''Calls fn with the frame time right before the next frame is rendered.
+        Without max_fps, frames with animation callbacks are capped to animation_fps.'''
+        self.animation_callbacks.append(fn)
+        self.schedule_render()
+
+    def run_animation_callbacks(self):
+        callbacks, self.animation_callbacks = self.animation_callbacks, []
+        now = clock()
+        for fn in callbacks:
+            fn(now)
+
+    def render(self, obj=None, differential=True):
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.begin()
+        if self.animation_callbacks:
+            self.run_animation_callbacks()
+            if profiler is not None:
+                profiler.mark('animation')
+        # Callbacks requesting the next frame keep it pending
+        self.dirty = bool(self.animation_callbacks)
+        self.last_frame = clock()
         if self.document.body is None:
+            if profiler is not None:
+                profiler.end()
             return
+        base = None
+        if self.output:
+            base = self.collapse_output()
+            if base is None:
+                differential = False
         h, w = self.document.height, self.document.width
-        doc = self.renderer.render(h, w, differential=differential)
-        try:
-            sys.stdout.write(doc)
-            sys.stdout.flush()
-        except:
-            if _retry < 3:
-                return self.render(obj, _retry+1)
+        doc = self.renderer.render(h, w, differential=differential, base=base)
+        if doc and self.sync:
+            doc = '\x1b[?2026h' + doc + '\x1b[?2026l'
+        doc = doc.encode('utf-8')
+        self.write(doc, self.renderer.screen)
+        if self.adaptive:
+            self.pace(len(doc))
+        if profiler is not None:
+            profiler.mark('write')
+            profiler.count('bytes', len(doc))
+            profiler.end()
+
+    def write(self, data, screen=None):
+        '''Queues output for the terminal. screen is the ScreenBuffer if the output is a frame.
+        Output is written to the raw stdout fd as far as the terminal accepts it without blocking, and the rest
+        once the event loop finds stdout writable.'''
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.output.append((data, screen))
+        self.flush_output()
+
+    def flush_output(self):
+        'Writes as much of the queued output as the terminal accepts without blocking'
+        while self.output:
+            data, screen = self.output[0]
+            try:
+                self.written += os.write(self.outfd, memoryview(data)[self.written:])
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if self.written < len(data):
+                continue
+            self.output.popleft()
+            self.written = 0
+            if screen is not None:
+                self.flushed_scr = screen
+
+    def drain_output(self):
+        'Blocks until all queued output is written'
+        while self.output:
+            select.select(tuple(), (self.outfd,), tuple())
+            self.flush_output()
+
+    def collapse_output(self):
+        '''Drops queued frames that have not started writing. Returns the ScreenBuffer the next frame must be compiled against,
+        the last frame that was, or is being, written.'''
+        base = self.flushed_scr
+        kept = deque([])
+        for n, (data, screen) in enumerate(self.output):
+            if screen is None or (n == 0 and self.written):
+                kept.append((data, screen))
+                if screen is not None:
+                    base = screen
+        self.output = kept
+        return base
+
+    def read_input(self):
+        'Reads available input, in chunks that grow while the terminal keeps filling them'
+        data = os.read(sys.stdin.fileno(), self.read_size)
+        if len(data) == self.read_size:
+            self.read_size = min(self.read_size * 2, 65536)
+        elif len(data) < self.read_size // 4:
+            self.read_size = max(self.read_size // 2, 1024)
+        return data
+
+    def feed_input(self, data):
+        '''Feeds input to the document, picking out terminal reports and pastes.
+        Bracketed paste mode is enabled, and a paste is dispatched as a single paste event carrying the whole text.
+        Input ending in what may be the start of a paste marker is held back until the next read, or taken as keys
+        if nothing follows within escape_timeout.'''
+        self.input_time = clock()
+        data, self.input_tail = self.input_tail + data, b''
+        data = self.handle_reports(data)
+        while data:
+            marker = PASTE_START if self.paste is None else PASTE_END
+            n = data.find(marker)
+            if n < 0:
+                # Keep what may be the start of a marker for the next read
+                keep = _partial_suffix(data, marker)
+                data, self.input_tail = data[:len(data)-keep], data[len(data)-keep:] + self.input_tail
+            if self.paste is None:
+                self.bytestream.feed(data if n < 0 else data[:n])
+                if n >= 0:
+                    self.paste = b''
+            else:
+                self.paste += data if n < 0 else data[:n]
+                if n >= 0:
+                    text, self.paste = self.paste.decode('utf-8', 'replace'), None
+                    self.document.event(Event('paste', (text,), {}))
+            data = b'' if n < 0 else data[n+len(marker):]
+
+    def input_timeout(self):
+        'Returns the time until input held back as the possible start of a marker is taken as keys, or None if there is none'
+        if not self.input_tail or self.paste is not None:
+            return None
+        return max(0, self.input_time + self.escape_timeout - clock())
+
+    def flush_input(self):
+        'Feeds input held back as the possible start of a marker to the document as keys, once no more has arrived in time'
+        if self.input_timeout() == 0:
+            data, self.input_tail = self.input_tail, b''
+            self.bytestream.feed(data)
+
+    def handle_reports(self, data):
+        'Picks terminal reports out of input, returning the remaining input. The start of a report ending the input is held back for the next read.'
+        for m in self.sync_report.finditer(data):
+            self.sync = m.group(1) in (b'1', b'2', b'3')
+        data = self.sync_report.sub(b'', data)
+        for kind, report in enumerate((self.device_report, self.status_report)):
+            data, n = report.subn(b'', data)
+            # Only one answer can be to the outstanding probe, and answers of
+            # the other kind are to a probe that was given up on
+            if n and kind == self.probe_kind and self.probe is not None:
+                self.acknowledge()
+        m = self.partial_report.search(data)
+        if m is not None:
+            data, self.input_tail = data[:m.start()], data[m.start():]
+        return data
+
+    def send_probe(self):
+        'Requests the device attributes or status, to be told when the output before the request has drained'
+        self.probe = (clock(), self.unprobed)
+        self.unprobed = 0
+        self.write('\x1b[5n' if self.probe_kind else '\x1b[c')
+
+    def pace(self, size):
+        '''Accounts for a frame of size bytes in adaptive mode, keeping the next one back until the link is estimated to have sent it.
+
+        Over links like slow SSH connections, output is accepted locally long before it is shown. A probe follows
+        frames, one at a time, and the time until the terminal answers it is the time the output before it took
+        to drain, see acknowledge. The updates rendered while the link is busy are coalesced into the next frame.
+        If a probe goes unanswered for probe_timeout, the measurements are dropped and the link is probed again,
+        switching between device attributes and device status requests so a late answer to the lost probe is
+        not taken for the answer to the new one.'''
+        now = clock()
+        rate = self.throughput()
+        if rate is not None:
+            self.link_free = max(self.link_free, now) + size / rate
+        self.unprobed += size
+        if self.probe is not None and now - self.probe[0] > self.probe_timeout:
+            # The answer got lost, so the link is measured again from scratch,
+            # with the other kind of probe in case the answer is only late
+            self.latency = None
+            self.link_bytes = self.link_busy = 0
+            self.link_free = 0
+            self.probe_kind = 1 - self.probe_kind
+            self.send_probe()
+        elif self.probe is None:
+            self.send_probe()
+
+    def acknowledge(self):
+        '''Measures the link from the answer to the outstanding probe.
+        The shortest drain time is taken as the latency of the link, and the rest as the time the link was busy
+        with the bytes, giving an estimate of its throughput. A link that keeps up is never found busy.'''
+        sent, size = self.probe
+        self.probe = None
+        drain = clock() - sent
+        if self.latency is None or drain < self.latency:
+            self.latency = drain
+        self.link_bytes = self.link_bytes * self.link_decay + size
+        self.link_busy = self.link_busy * self.link_decay + drain - self.latency
+        if self.unprobed:
+            self.send_probe()
+
+    def throughput(self):
+        'Returns the estimated bytes per second the link to the terminal sustains, or None if it has not been found busy'
+        if self.link_busy <= 0:
+            return None
+        return self.link_bytes / self.link_busy
 
     def getdimensions(self):
         h = bytearray(fcntl.ioctl(0, termios.TIOCGWINSZ, '1234'))
@@ -219,17 +978,17 @@ This class manages the entire application, from calling the renderer to dispatch
         signal.signal(signal.SIGCONT, lambda s,f: self.queue('restore'))
 
     def enable_alternate(self):
-        sys.stdout.write('\x1b[?25l')
-        sys.stdout.write('\x1b[?1049h')
-        sys.stdout.flush()
+        self.write('\x1b[?25l')
+        self.write('\x1b[?1049h')
+        self.write('\x1b[?2004h')
 
     def disable_alternate(self):
-        sys.stdout.write('\x1b[2J')
-        sys.stdout.write('\x1b[?1049l')
-        sys.stdout.flush()
+        self.write('\x1b[?2004l')
+        self.write('\x1b[2J')
+        self.write('\x1b[?1049l')
 
     def scroll(self, y):
-        self._scroll += y
+        self.document.scroll(y)
 
     def setup(self):
         self.oldattrs = termios.tcgetattr(sys.stdin)
@@ -240,37 +999,54 @@ This class manages the entire application, from calling the renderer to dispatch
         termios.tcsetattr(sys.stdin.fileno(), termios.TCSANOW, new_attrs)
 
         # make things non-blocking
-        fl = fcntl.fcntl(sys.stdin.fileno(), fcntl.F_GETFL)
-        fcntl.fcntl(sys.stdin.fileno(), fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        for fd in (sys.stdin.fileno(), self.outfd):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
     def cleanup(self):
         if self.oldattrs is not None:
             termios.tcsetattr(sys.stdin, termios.TCSANOW, self.oldattrs)
-        sys.stdout.write(Terminal.cursor_show())
-        sys.stdout.flush()
+        self.write(Terminal.cursor_show())
         self.disable_alternate()
+        self.drain_output()
 
-        fl = fcntl.fcntl(sys.stdin.fileno(), fcntl.F_GETFL)
-        fcntl.fcntl(sys.stdin.fileno(), fcntl.F_SETFL, fl & ~os.O_NONBLOCK)
+        for fd in (sys.stdin.fileno(), self.outfd):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl & ~os.O_NONBLOCK)
 
     def start(self):
         self.render()
         while True:
             try:
-                i,o,e = select.select((sys.stdin, self.waker), tuple(), tuple())
+                writers = (self.outfd,) if self.output else tuple()
+                timeouts = [t for t in (self.frame_timeout(), self.timer_timeout(), self.input_timeout()) if t is not None]
+                i,o,e = select.select((sys.stdin, self.waker), writers, tuple(), min(timeouts) if timeouts else None)
             except select.error:
                 continue
 
+            self.run_timers()
+
+            if o:
+                self.flush_output()
+
             for s in i:
                 if s == sys.stdin:
                     try:
-                        c = os.read(sys.stdin.fileno(), 128)
+                        c = self.read_input()
                     except IOError:
                         continue
-                    self.bytestream.feed(c)
+                    self.feed_input(c)
                 elif s == self.waker or len(self.pending) > 0:
                     self.waker.read(1024)
                     self.handle_queue()
+            self.flush_input()
+
+            # Render once input is drained. With a frame rate cap, or frames
+            # paced to the link, also render while input is still pending, so
+            # long bursts show progress.
+            if self.frame_timeout() == 0 and (not i or self.frame_interval is not None or
+                                              self.throughput() is not None):
+                self.render()
 
     def getdocument(self):
         return self.document